@@ -1,23 +1,161 @@
 import sublime
 import sublime_plugin
 import os
-import platform
-import re
-import glob
-from string import Template
+import socket
+import threading
+import time
+
+from related_file_resolver import (
+    CompiledConfiguration,
+    RelatedFileGraph,
+    RelatedFileResolver,
+    directory_cache,
+    invalidate_directory,
+    load_snapshot,
+    open_git_indexes,
+    related_files_cache,
+    request_daemon,
+    resolution_stats,
+    save_snapshot,
+    start_directory_watcher
+)
+from test_runner import print_to_view
+
+
+def get_cache_dir():
+    """
+        Get the directory GotoRelatedFile keeps its on-disk caches in,
+        creating it if needed.
+    """
+    if hasattr(sublime, 'cache_path'):
+        cache_dir = sublime.cache_path()
+    else:
+        cache_dir = os.path.join(os.path.dirname(sublime.packages_path()), 'Cache')
+
+    cache_dir = os.path.join(cache_dir, 'GotoRelatedFile')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
 
+    return cache_dir
 
-def insensitive_glob(pattern):
+
+class ConfigurationCache(object):
     """
-        Case insensitive glob.
-        From http://stackoverflow.com/questions/8151300/ignore-case-in-glob-on-linux.
+        Compiled configurations for each settings file.  A compiled
+        configuration is rebuilt only when its settings object reports a
+        change, or when a project enables a different set of configurations.
+
+        Once a snapshot path is set, the compiled configurations and cached
+        directory listings are saved there by save_snapshot(), and read back
+        the first time a configuration is needed in the next session.  A
+        configuration from the snapshot is only used if its digest matches
+        the current settings.
     """
-    if platform.system() == 'Windows':
-        return glob.glob(pattern)
 
-    def either(c):
-        return '[%s%s]' % (c.lower(), c.upper()) if c.isalpha() else c
-    return glob.glob(''.join(map(either, pattern)))
+    def __init__(self):
+        self._compiled = {}
+        self._watched_settings = set()
+        self._lock = threading.Lock()
+        self._snapshot_path = None
+        self._snapshot = None
+
+    def set_snapshot_path(self, snapshot_path):
+        with self._lock:
+            self._snapshot_path = snapshot_path
+            self._snapshot = None
+
+    def save_snapshot(self):
+        with self._lock:
+            snapshot_path = self._snapshot_path
+            compiled_configurations = list(self._compiled.values())
+
+        if snapshot_path:
+            save_snapshot(snapshot_path, compiled_configurations)
+
+    def _get_from_snapshot(self, digest):
+        """
+        Take the compiled configuration with digest from the snapshot,
+        reading the snapshot if it has not been read yet.  Called with the
+        lock held.
+        """
+        if self._snapshot is None:
+            self._snapshot = self._snapshot_path and load_snapshot(self._snapshot_path) or {}
+
+        return self._snapshot.pop(digest, None)
+
+    def get(self, settings_file, settings, project_configurations=None):
+        """
+        Get the CompiledConfiguration for settings_file.
+
+        :Args:
+            - settings_file: name of the settings file, e.g.
+              GotoRelatedFile.sublime-settings
+            - settings: the settings object loaded from settings_file
+            - project_configurations: enabled_configurations from the project
+              settings, which take precedence over the ones in settings_file
+
+        """
+        if settings_file not in self._watched_settings:
+            self._watched_settings.add(settings_file)
+            settings.add_on_change(
+                'goto_related_file_configuration',
+                lambda: self.invalidate(settings_file)
+            )
+
+        key = (settings_file, tuple(project_configurations or ()))
+
+        with self._lock:
+            compiled = self._compiled.get(key)
+            if compiled:
+                return compiled
+
+        if project_configurations:
+            enabled_configurations = project_configurations
+        else:
+            enabled_configurations = settings.get('enabled_configurations', [])
+
+        with self._lock:
+            compiled = self._get_from_snapshot(
+                CompiledConfiguration.get_digest(settings, enabled_configurations)
+            )
+
+        if not compiled:
+            compiled = CompiledConfiguration(settings, enabled_configurations)
+
+        with self._lock:
+            self._compiled[key] = compiled
+
+        return compiled
+
+    def invalidate(self, settings_file):
+        with self._lock:
+            for key in list(self._compiled):
+                if key[0] == settings_file:
+                    del self._compiled[key]
+
+
+configuration_cache = ConfigurationCache()
+
+
+def plugin_loaded():
+    # The snapshot itself is only read once a configuration is needed.
+    configuration_cache.set_snapshot_path(os.path.join(get_cache_dir(), 'snapshot.pickle'))
+
+
+def plugin_unloaded():
+    configuration_cache.save_snapshot()
+    related_files_cache.save()
+
+
+# Sublime Text 2 calls neither of the above.
+if int(sublime.version() or 0) < 3000:
+    plugin_loaded()
+
+    def unload_handler():
+        plugin_unloaded()
+
+
+SETTINGS_FILE = 'GotoRelatedFile.sublime-settings'
 
 
 class GotoRelatedFileCommand(sublime_plugin.TextCommand):
@@ -27,303 +165,511 @@ class GotoRelatedFileCommand(sublime_plugin.TextCommand):
 
         selector = FileSelector(
             window,
-            'GotoRelatedFile.sublime-settings',
-            window.active_view().file_name()
+            SETTINGS_FILE,
+            window.active_view().file_name(),
+            resolve=False
         )
 
-        if selector.files_found:
-            window.show_quick_panel(selector.get_items(), selector.select)
+        if selector.configuration:
+            RelatedFilesPanel(window, selector).show()
         else:
             sublime.status_message('No related files found.')
 
 
-class FileSelector(object):
+class GotoRelatedOfRelatedFileCommand(sublime_plugin.TextCommand):
+    """
+        Show the files related to the current file through its related
+        files, up to related_of_related_depth steps away, from the
+        RelatedFileGraph of the window's folders.
+    """
 
-    def __init__(self, window, config_file, current_file):
-        self.settings = sublime.load_settings(config_file)
-        self.window = window
-        self.view = window.active_view()
-        self.wildcard_vals_in_type_path = []
-        self.current_file = current_file
-        self.configuration = self._get_configuration()
-        if self.configuration:
-            self.related_files = self._get_related_files()
-            self.files_found = bool(self.related_files)
-        else:
-            self.files_found = False
+    def run(self, edit):
+        window = sublime.active_window()
+        current_file = window.active_view().file_name()
 
-    def select(self, index):
-        if index != -1:
-            selected_file = self.related_files[index][1]
-            if not os.path.isdir(os.path.dirname(selected_file)):
-                os.makedirs(os.path.dirname(selected_file))
-            self.window.open_file(selected_file)
+        selector = FileSelector(window, SETTINGS_FILE, current_file, resolve=False)
+        if not selector.configuration:
+            sublime.status_message('No related files found.')
+            return
 
-    def get_items(self):
-        return self.related_files
+        graph = get_related_file_graph(window, selector)
+        folders = window.folders()
+        depth = selector.settings.get('related_of_related_depth', 2)
 
-    def _get_configuration(self):
-        """
-            Search through the enabled configurations until one is found whose root
-            directory is contained in the current file's path.  Return the details
-            for that configuration, or None if no matches found.
+        def show(related_files):
+            selector.related_files = related_files
+            selector.files_found = bool(related_files)
+            if related_files:
+                window.show_quick_panel(selector.get_items(), selector.select)
+            else:
+                sublime.status_message('No related files found.')
 
-            Also saves the full path to the app dir to self.app_path.
-        """
-        if not self.current_file:
-            return None
+        def resolve():
+            selector.open_git_indexes()
+            if not graph.scanned:
+                graph.scan(folders)
 
-        # If project-specific enabled_configurations exist, use those.
-        if self.view.settings().get('enabled_configurations'):
-            configs = self.view.settings().get('enabled_configurations')
-        else:
-            configs = self.settings.get('enabled_configurations', [])
+            related_files = graph.get_transitively_related_files(current_file, depth)
+            sublime.set_timeout(lambda: show(related_files), 0)
 
-        valid_configs = {}
-        for config in configs:
-            config_details = self.settings.get(config)
-            if config_details:
-                valid_configs[config] = config_details
+        if not graph.scanned:
+            sublime.status_message('Finding the related files of every file in the project...')
 
-        paths = self._get_possible_paths(valid_configs)
+        run_async(resolve)
 
-        for config_key, path_dict in paths.items():
-            app_path = path_dict['app_path']
-            for path in path_dict['paths']:
 
-                search_string = os.sep + path + os.sep
+# The key and RelatedFileGraph of each window, by window id.
+related_file_graphs = {}
 
-                # Module wildcard {%} can match anything except directory separators.
-                search_string = re.escape(search_string) \
-                    .replace(
-                        re.escape('{%}'),
-                        '(?P<module>[^' + re.escape(os.sep) + ']+)'
-                    )
 
-                match = re.search(
-                    '^(.*?%s)' % search_string,
-                    self.current_file
+def get_related_file_graph(window, selector):
+    """
+        Get the RelatedFileGraph of the window's folders with the selector's
+        configuration, kept up to date by the directory watcher if there is
+        one.  Each window keeps one graph, which is replaced when its folders
+        or configuration change.
+    """
+    key = (tuple(window.folders()), selector.configuration_digest)
+    watcher = directory_cache.watcher
+    graph = None
+
+    if window.id() in related_file_graphs:
+        graph_key, graph = related_file_graphs[window.id()]
+        if graph_key != key:
+            if watcher is not None:
+                watcher.remove_listener(graph.directory_changed)
+            graph.close()
+            graph = None
+
+    if graph is None:
+        graph = RelatedFileGraph(
+            selector.compiled_configuration,
+            exclude=selector.resolver.exclude
+        )
+        related_file_graphs[window.id()] = (key, graph)
+        if watcher is not None:
+            watcher.add_listener(graph.directory_changed)
+
+    return graph
+
+
+class ShowGotoRelatedFilePerformanceStatsCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        print_to_view(
+            self.window.new_file(),
+            resolution_stats.format,
+            'GotoRelatedFile performance stats'
+        )
+
+
+class RelatedFilesPrefetcher(sublime_plugin.EventListener):
+    """
+        Resolves the related files of the active view in the background when
+        it is activated or loaded, so GotoRelatedFileCommand can show them
+        from related_files_cache straight away.
+    """
+
+    DELAY_MS = 300
+
+    def __init__(self):
+        self.pending = {}
+        self.cancelled = threading.Event()
+
+    def on_activated(self, view):
+        self._schedule(view)
+
+    def on_load(self, view):
+        self._schedule(view)
+
+    def _schedule(self, view):
+        if not view.file_name():
+            return
+
+        # Only the last event for a view within DELAY_MS triggers a prefetch.
+        token = self.pending.get(view.id(), 0) + 1
+        self.pending[view.id()] = token
+        sublime.set_timeout(lambda: self._prefetch(view, token), self.DELAY_MS)
+
+    def _prefetch(self, view, token):
+        if self.pending.get(view.id()) != token:
+            return
+        del self.pending[view.id()]
+
+        window = view.window()
+        if not window or window.active_view() is None \
+                or window.active_view().id() != view.id():
+            return
+
+        if not sublime.load_settings(SETTINGS_FILE).get('prefetch_related_files', True):
+            return
+
+        selector = FileSelector(window, SETTINGS_FILE, view.file_name(), resolve=False)
+        if not selector.configuration:
+            return
+
+        self.cancelled.set()
+        cancelled = self.cancelled = threading.Event()
+
+        def resolve():
+            related_files = []
+            for files in selector.iter_related_files(cancelled):
+                related_files += files
+
+            if not cancelled.is_set() and not selector.truncated:
+                related_files_cache.set(
+                    selector.cache_key,
+                    related_files,
+                    selector.seen_directories
                 )
-                if match:
-                    if 'module' in match.groupdict():
-                        app_path = app_path.replace('{%}', match.group('module'))
-                        path = path.replace('{%}', match.group('module'))
 
-                    path_before_app_path = match.group(0).rstrip(os.sep).replace(path, '')
-                    self.app_path = path_before_app_path + app_path
+        run_async(resolve)
 
-                    return valid_configs[config_key]
 
-        return None
+def run_async(callback):
+    """
+        Run callback off the UI thread.
+    """
+    if hasattr(sublime, 'set_timeout_async'):
+        sublime.set_timeout_async(callback, 0)
+    else:
+        thread = threading.Thread(target=callback)
+        thread.daemon = True
+        thread.start()
 
-    def _get_possible_paths(self, configs):
-        """
-        Get a dict where keys are configuration names and values are dicts
-        with keys 'app_path' and 'paths'.
 
-        'paths' will include the app_path, as well as any other possible paths
-        for that configuration which are implied by directory traversals in
-        type paths.
+class AsyncResolution(object):
+    """
+        Resolves the related files of a FileSelector off the UI thread, and
+        hands the files found for each rel_pattern back to the UI thread as
+        soon as that pattern is done.
 
-        :Args:
-            - configs: a dict of config settings
+        Only one resolution is in flight at a time; starting one cancels the
+        previous one, so stale work never delivers results.
+    """
 
-        """
-        possible_paths_for_app_path = {}
+    _current = None
+    _current_lock = threading.Lock()
 
-        for config_key in sorted(configs):
-            app_dir = configs[config_key]['app_dir'].replace('/', os.sep)
-            paths = [app_dir]
+    def __init__(self, selector, on_progress, on_done):
+        self.selector = selector
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.cancelled = threading.Event()
 
-            possible_paths_for_app_path[config_key] = {'app_path': app_dir}
+    def start(self):
+        with AsyncResolution._current_lock:
+            if AsyncResolution._current:
+                AsyncResolution._current.cancel()
+            AsyncResolution._current = self
 
-            for file_type, file_type_details in configs[config_key]['file_types'].items():
-                type_path = file_type_details['path']
-                if '..' in type_path:
-                    path_outside_of_app_path = os.path.realpath(
-                            app_dir + os.sep + type_path
-                        ).replace(os.path.realpath('.') + os.sep, '')
+        run_async(self._run)
 
-                    paths.append(path_outside_of_app_path)
+    def cancel(self):
+        self.cancelled.set()
 
-            possible_paths_for_app_path[config_key]['paths'] = paths
+    def _run(self):
+        for files in self.selector.iter_related_files(self.cancelled):
+            if self.cancelled.is_set():
+                return
+            if files:
+                sublime.set_timeout(self._deliver(self.on_progress, files), 0)
 
-        return possible_paths_for_app_path
+        sublime.set_timeout(self._deliver(self.on_done), 0)
 
-    def _get_current_file_type(self):
+    def _deliver(self, callback, *args):
+        def deliver():
+            if not self.cancelled.is_set():
+                callback(*args)
+        return deliver
 
-        # Sort types backwards, so that *, if present, is last.
-        types = self.configuration['file_types'].items()
-        types.sort()
-        types.reverse()
 
-        for file_type, details in types:
-            type_path = self._get_file_type_path(
-                details['path'].replace('/', os.sep),
-                self.current_file
+class RelatedFilesPanel(object):
+    """
+        Quick panel of a FileSelector's related files.
+
+        If related files for the current file are cached, in memory or from
+        a previous session, the panel is shown from the cache at once, and
+        re-shown if resolving them again in the background finds something
+        different, such as a file that has since been created or deleted.
+        Otherwise it is opened as soon as the first related file is found
+        and re-shown as more are found.  Either way it is not re-shown once
+        the user has closed it.
+    """
+
+    def __init__(self, window, selector):
+        self.window = window
+        self.selector = selector
+        self.resolution = AsyncResolution(selector, self._add_files, self._finish)
+        self.fresh_files = []
+        self.revalidating = False
+        self.shown_files = None
+        self.serial = 0
+        self.closed = False
+
+    def show(self):
+        cached_files = related_files_cache.get(self.selector.cache_key)
+        if cached_files is None:
+            resolution_stats.count('related_files_cache_misses')
+        else:
+            resolution_stats.count('related_files_cache_hits')
+
+        if cached_files:
+            self.revalidating = True
+            self._set_related_files(cached_files)
+            self._show_panel()
+
+        self.resolution.start()
+
+    def _add_files(self, files):
+        self.fresh_files += files
+        if not self.revalidating:
+            self._set_related_files(self.fresh_files)
+            self._show_panel()
+
+    def _finish(self):
+        if not self.selector.truncated:
+            related_files_cache.set(
+                self.selector.cache_key,
+                self.fresh_files,
+                self.selector.seen_directories
             )
 
-            if not type_path:
-                continue
+        self._set_related_files(self.fresh_files)
+        if not self.selector.files_found:
+            sublime.status_message('No related files found.')
+        elif self.selector.get_items() != self.shown_files:
+            self._show_panel()
 
-            search_string = os.path.realpath(
-                os.path.join(
-                    self.app_path,
-                    type_path
-                ).replace('/', os.sep)
-            )
+    def _set_related_files(self, related_files):
+        self.selector.related_files = list(related_files)
+        self.selector.files_found = bool(related_files)
 
-            match = re.search(
-                '^%s' % re.escape(search_string),
-                self.current_file
-            )
+    def _show_panel(self):
+        if self.closed:
+            return
 
-            if match:
-                return file_type
+        # Showing the panel again closes the one already open, whose callback
+        # must then be ignored.
+        self.serial += 1
+        serial = self.serial
+        items = self.shown_files = list(self.selector.get_items())
 
-    def _get_file_type_path(self, path_pattern, file_path):
-        """
-        Get the file type path given the path pattern and the path of
-        a file of that type.  Paths with a {%} wildcard will be replaced
-        with the actual value used in the file path.
+        self.window.show_quick_panel(
+            items,
+            lambda index: self._select(serial, items, index)
+        )
 
-        """
-        pattern = os.path.realpath(self.app_path + os.sep + path_pattern)
+    def _select(self, serial, items, index):
+        if serial != self.serial:
+            return
 
-        if '{%}' not in pattern:
-            return pattern
+        self.closed = True
+        self.resolution.cancel()
+        self.selector.related_files = items
+        self.selector.select(index)
 
-        pattern = re.escape(pattern) \
-            .replace(re.escape('{%}'), '([^' + re.escape(os.sep) + ']+)')
 
-        match = re.search(
-            pattern,
-            file_path
-        )
-        if match:
-            self.wildcard_vals_in_type_path = match.groups()
-            return match.group(0)
+class FileSelector(object):
 
-    def _get_template_var_values(self):
+    def __init__(self, window, config_file, current_file, resolve=True):
+        self.config_file = config_file
+        self.settings = sublime.load_settings(config_file)
+        self.window = window
+        self.view = window.active_view()
+        self.current_file = current_file
+        self.configuration_digest = None
+        self.compiled_configuration = None
+        self.configuration = self._get_configuration()
+        self.related_files = []
+        self.files_found = False
+        self.truncated_by_daemon = False
+
+        if self.configuration and self.settings.get('remember_related_files', True):
+            related_files_cache.load(os.path.join(get_cache_dir(), 'related_files.json'))
+
+        # Opening the git indexes runs git, so it is left to the resolution,
+        # which runs off the UI thread.
+        self.git_folders = []
+        if self.configuration and self.settings.get('listing_backend') == 'git':
+            self.git_folders = window.folders()
+
+        if self.configuration and self.settings.get('watch_directories', True):
+            start_directory_watcher()
+
+        directory_cache.set_io_threads(self.settings.get('io_threads', 0))
+
+        stats_log_file = self.settings.get('stats_log_file')
+        resolution_stats.log_file = stats_log_file and os.path.expanduser(stats_log_file)
+
+        if self.configuration and resolve:
+            self.related_files = self._get_related_files()
+            self.files_found = bool(self.related_files)
+
+    def select(self, index):
+        if index != -1 and self.related_files[index][1]:
+            # A file that no longer exists, even if it was listed to be
+            # opened, is created like any other.
+            selected_file = self.related_files[index][1]
+            selected_dir = os.path.dirname(selected_file)
+            if not os.path.isdir(selected_dir):
+                # The listing of the deepest existing ancestor changes.
+                existing_dir = selected_dir
+                while existing_dir and not os.path.isdir(existing_dir):
+                    existing_dir = os.path.dirname(existing_dir)
+
+                os.makedirs(selected_dir)
+                invalidate_directory(existing_dir)
+            self.window.open_file(selected_file)
+
+    def get_items(self):
+        # The entries marking truncated results have no path.
+        return [[label, path or ''] for label, path in self.related_files]
+
+    @property
+    def cache_key(self):
+        return (self.current_file, self.configuration_digest)
+
+    def _get_configuration(self):
         """
-            Get a dictionary mapping the supported template variables and their
-            values for the active file.
+            Search through the enabled configurations until one is found whose root
+            directory is contained in the current file's path.  Return the details
+            for that configuration, or None if no matches found.
+
+            Also saves the full path to the app dir to self.app_path.
         """
-        current_file_type_details = self._get_file_type_details(self._get_current_file_type())
+        if not self.current_file:
+            return None
 
-        current_file_type_path = self._get_file_type_path(
-            current_file_type_details.get('path', '').replace('/', os.sep),
-            self.current_file
+        # If project-specific enabled_configurations exist, use those.
+        compiled_configuration = configuration_cache.get(
+            self.config_file,
+            self.settings,
+            self.view.settings().get('enabled_configurations')
         )
 
-        current_suffix = current_file_type_details.get('suffix', '')
-        current_prefix = current_file_type_details.get('prefix', '')
-
-        current_file_no_ext = os.path.splitext(self.current_file)[0]
-        current_file_no_suffix = re.sub('%s$' % re.escape(current_suffix), '', current_file_no_ext)
-        current_file_no_fixes = re.sub(
-            '%s([^%s]+)$' % (re.escape(current_prefix), re.escape(os.sep)),
-            '\g<1>',
-            current_file_no_suffix
+        self.configuration_digest = compiled_configuration.digest
+        self.compiled_configuration = compiled_configuration
+        start = time.time()
+        self.compiled_config, self.app_path = compiled_configuration.match(
+            self.current_file
         )
-        current_file = current_file_no_fixes
 
-        current_file_type_path = os.path.realpath(
-            os.path.join(self.app_path, current_file_type_path)
-        )
+        if self.compiled_config:
+            limits = self._get_limits()
+            self.resolver = RelatedFileResolver(
+                self.compiled_config,
+                self.app_path,
+                self.current_file,
+                timeout=limits['timeout_ms'] and limits['timeout_ms'] / 1000.0,
+                max_results=limits['max_results'],
+                max_results_per_pattern=limits['max_results_per_pattern'],
+                exclude=self.compiled_config.get_exclude_patterns(
+                    limits['folder_exclude_patterns'],
+                    limits['file_exclude_patterns']
+                )
+            )
+            self.resolver.timings['configuration_match'] = time.time() - start
+            return self.compiled_config.details
 
-        file_from_type_path = current_file.replace(current_file_type_path, '', 1).strip(os.sep)
-        file_from_app_path = current_file.replace(self.app_path, '', 1).strip(os.sep)
-        dir_from_type_path = os.path.dirname(file_from_type_path).strip(os.sep)
+        return None
 
+    @property
+    def seen_directories(self):
+        return self.resolver.seen_directories
+
+    def _get_limits(self):
+        """
+            Get the limits resolutions are held to and the patterns of the
+            folders and files they leave out.
+        """
+        view_settings = self.view.settings()
         return {
-            'base_filename': os.path.basename(current_file),
-            'file_from_type_path': file_from_type_path,
-            'file_from_app_path': file_from_app_path,
-            'dir_from_type_path': dir_from_type_path
+            'timeout_ms': self.settings.get('resolve_timeout_ms', 1000),
+            'max_results': self.settings.get('max_related_files', 500) or None,
+            'max_results_per_pattern': self.settings.get('max_related_files_per_pattern', 100) or None,
+            'folder_exclude_patterns': view_settings.get('folder_exclude_patterns', []),
+            'file_exclude_patterns': view_settings.get('file_exclude_patterns', [])
         }
 
-    def _get_file_type_details(self, file_type):
-        file_type_details = self.configuration \
-            .get('file_types', {}) \
-            .get(file_type, {})
+    @property
+    def truncated(self):
+        return self.truncated_by_daemon or self.resolver.truncated
+
+    def iter_related_files(self, cancelled=None):
+        """
+            Resolve the rel_patterns of the current file one at a time,
+            yielding the list of related files found for each.  Stops early
+            if the cancelled event is set.
 
-        return file_type_details
+            If a daemon_socket is set, the related files are instead asked
+            of the daemon listening on it, all at once.
+        """
+        related_files = self._get_related_files_from_daemon()
+        if related_files is not None:
+            return iter([related_files])
 
-    def _is_creatable_file(self, glob_pattern):
-        return '*' not in glob_pattern
+        self.open_git_indexes()
+        return self.resolver.iter_related_files(cancelled)
 
     def _get_related_files(self):
         """
             Return list of lists with element 0 the file description
             and element 1 the path.
         """
-        current_file_type = self._get_current_file_type()
-
-        if current_file_type is None:
-            return
-
-        current_file_type_details = self._get_file_type_details(
-            current_file_type
-        )
-
-        if not current_file_type_details:
-            return
-
-        template_vars = self._get_template_var_values()
+        related_files = self._get_related_files_from_daemon()
+        if related_files is not None:
+            return related_files
 
-        patterns = current_file_type_details.get('rel_patterns', {})
+        self.open_git_indexes()
+        return self.resolver.get_related_files()
 
-        related_files = []
-        for file_type, pattern in patterns.items():
-
-            target_file_type_details = self._get_file_type_details(file_type)
-            target_suffix = target_file_type_details.get('suffix', '')
-            target_prefix = target_file_type_details.get('prefix', '')
-
-            target_file_type_path = target_file_type_details.get('path', '').replace('/', os.sep)
+    def open_git_indexes(self):
+        """
+            Make sure the git indexes of the window's folders are open if the
+            listing_backend is git.  Runs git the first time, so it is called
+            off the UI thread.
+        """
+        if self.git_folders:
+            open_git_indexes(self.git_folders)
 
-            for val in self.wildcard_vals_in_type_path:
-                target_file_type_path = target_file_type_path.replace('{%}', val, 1)
+    def _get_related_files_from_daemon(self):
+        """
+            Get the related files of the current file from the daemon at
+            daemon_socket, or None if there is none, it can't be reached, its
+            settings don't have the same configurations, or none of them
+            matches the current file.
+        """
+        daemon_socket = self.settings.get('daemon_socket')
+        if not daemon_socket:
+            return None
 
-            template = Template(pattern.replace('/', os.sep))
-            glob_pattern = template.safe_substitute(
-                app_path=self.app_path,
-                type_path=target_file_type_path,
-                full_type_path=self.app_path + os.sep + target_file_type_path,
-                base_filename=template_vars['base_filename'],
-                file_from_type_path=template_vars['file_from_type_path'],
-                file_from_app_path=template_vars['file_from_app_path'],
-                dir_from_type_path=template_vars['dir_from_type_path'],
-                suffix=''  # For backward compatability
+        request = self._get_limits()
+        request.update({
+            'op': 'resolve',
+            'file': self.current_file,
+            'configurations': [config.name for config in self.compiled_configuration.configs],
+            'digest': self.configuration_digest
+        })
+
+        # The daemon stops resolving when the timeout passes, and is given a
+        # second more to answer.
+        timeout_ms = request['timeout_ms']
+        try:
+            response = request_daemon(
+                os.path.expanduser(daemon_socket),
+                request,
+                timeout_ms and timeout_ms / 1000.0 + 1 or None
             )
+        except (socket.error, ValueError):
+            return None
 
-            # Add prefix and suffix to glob_pattern
-            glob_pattern = re.sub(
-                '(.+?)([^%s]+)\.([^.]+)$' % re.escape(os.sep),
-                '\g<1>%s\g<2>%s.\g<3>' % (target_prefix, target_suffix),
-                glob_pattern
-            )
+        if not response.get('ok') or not response['result']['configuration']:
+            return None
 
-            # Collect matches
-            matches = insensitive_glob(os.path.realpath(glob_pattern))
-
-            related_files += [
-                ['Open %s (%s)' % (file_type, os.path.basename(match)), match]
-                for match in matches
-                if os.path.isfile(match)
-            ]
-
-            if (not matches and self._is_creatable_file(glob_pattern)):
-                creatable_file_path = os.path.realpath(glob_pattern)
-                related_files.append(
-                    [
-                        'Create %s (%s)' % (
-                            file_type,
-                            os.path.basename(creatable_file_path)
-                        ),
-                        creatable_file_path
-                    ]
-                )
+        self.truncated_by_daemon = response['result']['truncated']
+        return [
+            [related['label'], related['path']]
+            for related in response['result']['related']
+        ]
 
-        return related_files
@@ -0,0 +1,526 @@
+"""
+    Benchmarks for the resolution engine in related_file_resolver.py.
+
+    Generates a synthetic project in the style of the kohana and chaplin
+    configurations, resolves the related files of a sample of its files, and
+    reports the latency of each phase of the resolution along with memory use:
+
+        python benchmark.py --files 100000 --samples 500
+
+    With --check, the results are also compared against a reference
+    implementation of the original glob-based resolution, and any file whose
+    related files differ is reported.
+"""
+import os
+import re
+import sys
+import glob
+import time
+import random
+import shutil
+import platform
+import tempfile
+import optparse
+from string import Template
+
+from related_file_resolver import (
+    CompiledConfiguration,
+    RelatedFileResolver,
+    directory_cache
+)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+PHASES = [
+    'configuration_match',
+    'type_detection',
+    'template_vars',
+    'globbing',
+    'total'
+]
+
+
+def get_configurations():
+    """
+        The kohana and chaplin configurations from the default settings, with
+        a chaplin "style" type whose path traverses out of the app dir.
+    """
+    return {
+        'kohana': {
+            'app_dir': 'application',
+            'file_types': {
+                'controller': {
+                    'path': 'classes/Controller',
+                    'rel_patterns': {
+                        'template': '${app_path}/${type_path}/${file_from_type_path}/*',
+                        'view': '${app_path}/${type_path}/${file_from_type_path}/*',
+                        'test': '${app_path}/${type_path}/${file_from_app_path}${suffix}.php'
+                    }
+                },
+                'view': {
+                    'path': 'classes/View/Page',
+                    'rel_patterns': {
+                        'controller': '${app_path}/${type_path}/${dir_from_type_path}.php',
+                        'template': '${app_path}/${type_path}/${file_from_type_path}.mustache',
+                        'test': '${app_path}/${type_path}/${file_from_app_path}${suffix}.php'
+                    }
+                },
+                'template': {
+                    'path': 'templates',
+                    'rel_patterns': {
+                        'controller': '${app_path}/${type_path}/${dir_from_type_path}.php',
+                        'view': '${app_path}/${type_path}/${file_from_type_path}.php'
+                    }
+                },
+                'test': {
+                    'path': 'tests',
+                    'suffix': 'Test',
+                    'rel_patterns': {
+                        '*': '${app_path}/${file_from_type_path}.php'
+                    }
+                }
+            }
+        },
+        'chaplin': {
+            'app_dir': 'httpdocs/_media',
+            'file_types': {
+                'controller': {
+                    'path': 'js/{%}/controllers',
+                    'suffix': '_controller',
+                    'rel_patterns': {
+                        'templates': '${app_path}/${type_path}/${file_from_type_path}/*',
+                        'view': '${app_path}/${type_path}/${file_from_type_path}/*'
+                    }
+                },
+                'template': {
+                    'path': 'js/{%}/templates',
+                    'rel_patterns': {
+                        'controller': '${app_path}/${type_path}/${dir_from_type_path}.js',
+                        'view': '${app_path}/${type_path}/${file_from_type_path}.js'
+                    }
+                },
+                'view': {
+                    'path': 'js/{%}/views',
+                    'rel_patterns': {
+                        'controller': '${app_path}/${type_path}/${dir_from_type_path}.js',
+                        'template': '${app_path}/${type_path}/${file_from_type_path}.hbs',
+                        'scss': '${app_path}/${type_path}/${file_from_type_path}.scss',
+                        'style': '${app_path}/${type_path}/${file_from_type_path}.css'
+                    }
+                },
+                'scss': {
+                    'path': 'scss/pages',
+                    'prefix': '_',
+                    'rel_patterns': {
+                        'view': '${app_path}/js/app/views/${file_from_type_path}.js'
+                    }
+                },
+                'style': {
+                    'path': '../styles',
+                    'rel_patterns': {
+                        'view': '${app_path}/js/app/views/${file_from_type_path}.js'
+                    }
+                }
+            }
+        }
+    }
+
+
+def create_file(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    open(path, 'w').close()
+
+
+def generate_tree(root, style, file_count, rng):
+    """
+        Create roughly file_count files under root, laid out the way the
+        kohana or chaplin configuration expects.  Return their paths.
+    """
+    files = []
+
+    if style == 'kohana':
+        app = os.path.join(root, 'application')
+        for i in range(max(1, file_count // 8)):
+            controller = 'Section%d%sController%d' % (i // 100, os.sep, i)
+            files.append(os.path.join(app, 'classes', 'Controller', controller + '.php'))
+            files.append(os.path.join(app, 'tests', 'classes', 'Controller', controller + 'Test.php'))
+            for action in ('index', 'edit', 'show'):
+                view = os.path.join(controller, action)
+                files.append(os.path.join(app, 'classes', 'View', 'Page', view + '.php'))
+                files.append(os.path.join(app, 'templates', view + '.mustache'))
+    else:
+        media = os.path.join(root, 'httpdocs', '_media')
+        modules = ['app'] + ['module%d' % i for i in range(max(1, file_count // 5000))]
+        for i in range(max(1, file_count // 9)):
+            module = modules[i % len(modules)]
+            js = os.path.join(media, 'js', module)
+            name = 'page%d' % i
+            files.append(os.path.join(js, 'controllers', name + '_controller.js'))
+            for part in ('header', 'body', 'footer', 'sidebar'):
+                view = os.path.join(name, part)
+                files.append(os.path.join(js, 'views', view + '.js'))
+                files.append(os.path.join(js, 'templates', view + '.hbs'))
+            if module == 'app' and rng.random() < 0.5:
+                files.append(os.path.join(media, 'scss', 'pages', name, '_header.scss'))
+                files.append(os.path.join(root, 'httpdocs', 'styles', name, 'header.css'))
+
+    for path in files:
+        create_file(path)
+
+    # Listings of directories modified within the last few seconds are not
+    # cached, so age the tree as if it had been checked out a while ago.
+    an_hour_ago = time.time() - 3600
+    for dir_path, dir_names, file_names in os.walk(root):
+        os.utime(dir_path, (an_hour_ago, an_hour_ago))
+
+    return files
+
+
+def insensitive_glob(pattern):
+    """
+        Case insensitive glob, as the original implementation did it.
+    """
+    if platform.system() == 'Windows':
+        return glob.glob(pattern)
+
+    def either(c):
+        return '[%s%s]' % (c.lower(), c.upper()) if c.isalpha() else c
+    return glob.glob(''.join(map(either, pattern)))
+
+
+class ReferenceResolver(object):
+    """
+        The original glob-based resolution, kept as the reference that
+        optimized engines must agree with.  Configurations are tried in
+        enabled order.
+    """
+
+    def __init__(self, settings, enabled_configurations, current_file):
+        self.settings = settings
+        self.enabled_configurations = enabled_configurations
+        self.current_file = current_file
+        self.wildcard_vals_in_type_path = []
+        self.configuration = self._get_configuration()
+
+    def get_related_files(self):
+        if not self.configuration:
+            return None
+
+        current_file_type = self._get_current_file_type()
+        if current_file_type is None:
+            return None
+
+        current_file_type_details = self._get_file_type_details(current_file_type)
+        template_vars = self._get_template_var_values()
+        patterns = current_file_type_details.get('rel_patterns', {})
+
+        related_files = []
+        for file_type, pattern in patterns.items():
+            target_file_type_details = self._get_file_type_details(file_type)
+            target_suffix = target_file_type_details.get('suffix', '')
+            target_prefix = target_file_type_details.get('prefix', '')
+            target_file_type_path = target_file_type_details.get('path', '').replace('/', os.sep)
+
+            for val in self.wildcard_vals_in_type_path:
+                target_file_type_path = target_file_type_path.replace('{%}', val, 1)
+
+            glob_pattern = Template(pattern.replace('/', os.sep)).safe_substitute(
+                app_path=self.app_path,
+                type_path=target_file_type_path,
+                full_type_path=self.app_path + os.sep + target_file_type_path,
+                suffix='',
+                **template_vars
+            )
+
+            glob_pattern = re.sub(
+                r'(.+?)([^%s]+)\.([^.]+)$' % re.escape(os.sep),
+                r'\g<1>%s\g<2>%s.\g<3>' % (target_prefix, target_suffix),
+                glob_pattern
+            )
+
+            matches = insensitive_glob(os.path.realpath(glob_pattern))
+
+            related_files += [
+                ['Open %s (%s)' % (file_type, os.path.basename(match)), match]
+                for match in matches
+                if os.path.isfile(match)
+            ]
+
+            if not matches and '*' not in glob_pattern:
+                creatable_file_path = os.path.realpath(glob_pattern)
+                related_files.append([
+                    'Create %s (%s)' % (file_type, os.path.basename(creatable_file_path)),
+                    creatable_file_path
+                ])
+
+        return related_files
+
+    def _get_configuration(self):
+        for config_key in self.enabled_configurations:
+            details = self.settings.get(config_key)
+            if not details:
+                continue
+
+            app_dir = details['app_dir'].replace('/', os.sep)
+            paths = [app_dir]
+            for file_type_details in details['file_types'].values():
+                if '..' in file_type_details['path']:
+                    paths.append(
+                        os.path.realpath(app_dir + os.sep + file_type_details['path'])
+                        .replace(os.path.realpath('.') + os.sep, '')
+                    )
+
+            for path in paths:
+                search_string = re.escape(os.sep + path + os.sep).replace(
+                    re.escape('{%}'),
+                    '(?P<module>[^' + re.escape(os.sep) + ']+)'
+                )
+                match = re.search('^(.*?%s)' % search_string, self.current_file)
+                if match:
+                    app_path = app_dir
+                    if 'module' in match.groupdict():
+                        app_path = app_path.replace('{%}', match.group('module'))
+                        path = path.replace('{%}', match.group('module'))
+
+                    self.app_path = match.group(0).rstrip(os.sep).replace(path, '') + app_path
+                    return details
+
+        return None
+
+    def _get_current_file_type(self):
+        for file_type, details in sorted(self.configuration['file_types'].items(), reverse=True):
+            type_path = self._get_file_type_path(
+                details['path'].replace('/', os.sep),
+                self.current_file
+            )
+            if not type_path:
+                continue
+
+            search_string = os.path.realpath(os.path.join(self.app_path, type_path))
+            if self.current_file.startswith(search_string):
+                return file_type
+
+    def _get_file_type_path(self, path_pattern, file_path):
+        pattern = os.path.realpath(self.app_path + os.sep + path_pattern)
+        if '{%}' not in pattern:
+            return pattern
+
+        pattern = re.escape(pattern).replace(
+            re.escape('{%}'),
+            '([^' + re.escape(os.sep) + ']+)'
+        )
+        match = re.search(pattern, file_path)
+        if match:
+            self.wildcard_vals_in_type_path = match.groups()
+            return match.group(0)
+
+    def _get_template_var_values(self):
+        details = self._get_file_type_details(self._get_current_file_type())
+        type_path = self._get_file_type_path(
+            details.get('path', '').replace('/', os.sep),
+            self.current_file
+        )
+
+        current_file = re.sub(
+            '%s$' % re.escape(details.get('suffix', '')),
+            '',
+            os.path.splitext(self.current_file)[0]
+        )
+        current_file = re.sub(
+            '%s([^%s]+)$' % (re.escape(details.get('prefix', '')), re.escape(os.sep)),
+            r'\g<1>',
+            current_file
+        )
+        type_path = os.path.realpath(os.path.join(self.app_path, type_path))
+
+        file_from_type_path = current_file.replace(type_path, '', 1).strip(os.sep)
+        return {
+            'base_filename': os.path.basename(current_file),
+            'file_from_type_path': file_from_type_path,
+            'file_from_app_path': current_file.replace(self.app_path, '', 1).strip(os.sep),
+            'dir_from_type_path': os.path.dirname(file_from_type_path).strip(os.sep)
+        }
+
+    def _get_file_type_details(self, file_type):
+        return self.configuration.get('file_types', {}).get(file_type, {})
+
+
+def time_resolution(compiled_configuration, file_path):
+    """
+        Resolve the related files of file_path.  Return a dict of the seconds
+        spent in each phase, as timed by the resolver, and the related files.
+    """
+    start = time.time()
+    config, app_path = compiled_configuration.match(file_path)
+    configuration_match = time.time() - start
+
+    timings = {}
+    related_files = None
+    if config:
+        resolver = RelatedFileResolver(config, app_path, file_path)
+        if resolver.get_context():
+            related_files = resolver.get_related_files()
+        timings = dict(resolver.timings)
+
+    timings['configuration_match'] = configuration_match
+    timings['total'] = sum(timings.values())
+    return timings, related_files
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def report(title, samples):
+    lines = [title]
+    lines.append('  %-20s %10s %10s %10s %10s' % ('phase (ms)', 'p50', 'p95', 'p99', 'max'))
+    for phase in PHASES:
+        values = sorted(sample[phase] * 1000 for sample in samples if phase in sample)
+        lines.append('  %-20s %10.3f %10.3f %10.3f %10.3f' % (
+            phase,
+            percentile(values, 0.5),
+            percentile(values, 0.95),
+            percentile(values, 0.99),
+            values[-1] if values else 0
+        ))
+    return '\n'.join(lines)
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere.
+    if sys.platform == 'darwin':
+        return max_rss / 1024.0 / 1024.0
+    return max_rss / 1024.0
+
+
+def run_benchmark(style, file_count, sample_count, check, rng, root):
+    settings = get_configurations()
+    style_root = os.path.join(root, style)
+
+    start = time.time()
+    files = generate_tree(style_root, style, file_count, rng)
+    print('%s: generated %d files in %.1fs' % (style, len(files), time.time() - start))
+
+    compiled_configuration = CompiledConfiguration(settings, [style])
+    samples = rng.sample(files, min(sample_count, len(files)))
+
+    directory_cache.clear()
+    cold = [time_resolution(compiled_configuration, path)[0] for path in samples]
+
+    warm = [time_resolution(compiled_configuration, path)[0] for path in samples]
+
+    traced_peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        for path in samples:
+            time_resolution(compiled_configuration, path)
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    print(report('%s: cold directory cache' % style, cold))
+    print(report('%s: warm directory cache' % style, warm))
+
+    rss = max_rss_mb()
+    if rss is not None:
+        print('%s: max RSS %.1f MB' % (style, rss))
+    if traced_peak is not None:
+        print('%s: peak traced allocations while warm %.1f MB' % (style, traced_peak / 1024.0 / 1024.0))
+
+    mismatches = 0
+    if check:
+        for path in samples:
+            expected = ReferenceResolver(settings, [style], path).get_related_files()
+            actual = time_resolution(compiled_configuration, path)[1]
+            if expected != actual:
+                mismatches += 1
+                print('%s: MISMATCH for %s\n  expected %r\n  actual   %r' % (
+                    style, path, expected, actual
+                ))
+        print('%s: %d of %d sampled files match the reference' % (
+            style, len(samples) - mismatches, len(samples)
+        ))
+
+    return mismatches
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '--style',
+        choices=['kohana', 'chaplin', 'both'],
+        default='both',
+        help='layout of the synthetic project (default: both)'
+    )
+    parser.add_option(
+        '--files',
+        type='int',
+        default=10000,
+        help='approximate number of files to generate per style (default: 10000)'
+    )
+    parser.add_option(
+        '--samples',
+        type='int',
+        default=200,
+        help='number of files to resolve (default: 200)'
+    )
+    parser.add_option(
+        '--check',
+        action='store_true',
+        help='compare results against the reference implementation'
+    )
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option(
+        '--root',
+        help='directory to generate the project in; a temporary directory '
+             'that is removed afterwards by default'
+    )
+    options, args = parser.parse_args(argv)
+
+    rng = random.Random(options.seed)
+    root = options.root or tempfile.mkdtemp(prefix='goto_related_file_benchmark')
+    root = os.path.realpath(root)
+
+    # Type paths with traversals are resolved relative to the working dir.
+    original_cwd = os.getcwd()
+    os.chdir(root)
+
+    styles = ['kohana', 'chaplin'] if options.style == 'both' else [options.style]
+    mismatches = 0
+    try:
+        for style in styles:
+            mismatches += run_benchmark(
+                style,
+                options.files,
+                options.samples,
+                options.check,
+                rng,
+                root
+            )
+    finally:
+        os.chdir(original_cwd)
+        if not options.root:
+            shutil.rmtree(root)
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,19 @@
 import sublime
 import unittest
-from GotoRelatedFile import FileSelector
+from GotoRelatedFile import FileSelector, configuration_cache
+from GotoRelatedFile import get_related_file_graph, related_file_graphs
+from related_file_resolver import RelatedFilesCache, DirectoryWatcher
+from related_file_resolver import CompiledConfiguration, directory_cache
+from related_file_resolver import ResolutionStats, load_settings_file, resolve, resolution_stats
+from related_file_resolver import GlobPlan, DirectoryCache, scandir
+from related_file_resolver import iter_insensitive_globs, ExcludePatterns, GitIndexSource, run_git
+from related_file_resolver import RelatedFileGraph, PathTrie, save_snapshot, load_snapshot
+from related_file_resolver import path_normalizer, PathNormalizer, ResolverDaemon, request_daemon
 
 import os
 import shutil
+import threading
+import time
 
 
 class TestFileSelector(unittest.TestCase):
@@ -13,10 +23,15 @@ class TestFileSelector(unittest.TestCase):
         self.settings_file = 'test_settings.sublime-settings'
 
         self.createDefaultSettings()
+        self.daemons = []
 
         self.deleteTempTestFiles()
 
     def tearDown(self):
+        for daemon, thread in self.daemons:
+            daemon.shutdown()
+            thread.join()
+
         self.deleteTempTestFiles()
 
     def deleteTempTestFiles(self):
@@ -28,6 +43,8 @@ class TestFileSelector(unittest.TestCase):
         if os.path.isdir(js_test_dir):
             shutil.rmtree(js_test_dir)
 
+        path_normalizer.clear()
+
     def resetSettings(self):
         settings = sublime.load_settings(self.settings_file)
 
@@ -35,6 +52,7 @@ class TestFileSelector(unittest.TestCase):
         settings.erase('js')
         settings.erase('py')
         settings.erase('py-no-controllers')
+        settings.erase('daemon_socket')
 
         return settings
 
@@ -115,6 +133,13 @@ class TestFileSelector(unittest.TestCase):
         else:
             raise Exception('Could not create file "%s".' % path)
 
+    def globTogether(self, patterns, cache, seen, **options):
+        results = [[] for pattern in patterns]
+        for index, path in iter_insensitive_globs(patterns, cache, seen, **options):
+            results[index].append(path)
+
+        return results
+
     def getJsConfig(self):
         return {
             "app_dir": "js/app",
@@ -618,3 +643,1051 @@ class TestFileSelector(unittest.TestCase):
         self.assertEquals(len(related_files), 1)
         self.assertEquals(related_files[0][1], self.view_path)
 
+
+    def testRelatedFilesAreMatchedCaseInsensitively(self):
+        self.setUpFilesForPyConfig()
+
+        os.rename(
+            self.template_path,
+            os.sep.join([os.path.dirname(self.template_path), 'BAR.html'])
+        )
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            self.view_path
+        )
+
+        related_files = file_selector.related_files
+        self.assertEquals(len(related_files), 2)
+        self.assertEquals(related_files[1][0], 'Open template (BAR.html)')
+
+    def testRelatedFilesAreMatchedExactlyInCaseSensitiveConfigurations(self):
+        self.setUpFilesForPyConfig()
+
+        os.rename(
+            self.template_path,
+            os.sep.join([os.path.dirname(self.template_path), 'BAR.html'])
+        )
+
+        settings = sublime.load_settings(self.settings_file)
+        config = self.getPyConfig()
+        config['case_sensitive'] = True
+        settings.set('py', config)
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            self.view_path
+        )
+
+        related_files = file_selector.related_files
+        self.assertEquals(len(related_files), 2)
+        self.assertEquals(related_files[1], ['Create template (bar.html)', self.template_path])
+
+    def testDirectoryListingIsReusedUntilDirectoryChanges(self):
+        self.setUpFilesForPyConfig()
+
+        listing_dir = os.path.dirname(self.template_path)
+        an_hour_ago = time.time() - 3600
+        os.utime(listing_dir, (an_hour_ago, an_hour_ago))
+
+        listing = directory_cache.listing(listing_dir, directory_cache.begin_resolution())
+        listing_again = directory_cache.listing(listing_dir, directory_cache.begin_resolution())
+        self.assertTrue(listing_again is listing)
+
+        self.createFile(os.sep.join([listing_dir, 'Baz.html']))
+
+        listing = directory_cache.listing(listing_dir, directory_cache.begin_resolution())
+        self.assertEquals(listing.folded['baz.html'], ['Baz.html'])
+
+    def testPatternsSharingDirectoriesAreGlobbedTogether(self):
+        self.setUpFilesForPyConfig()
+
+        cache = DirectoryCache()
+        seen = cache.begin_resolution()
+        views_path = os.sep.join([self.test_data_path, 'application', 'views'])
+
+        results = self.globTogether(
+            [
+                os.sep.join([views_path, 'foo', '*']),
+                os.sep.join([views_path, '*', 'BAR.py']),
+                os.sep.join([views_path, 'foo', 'baz.py'])
+            ],
+            cache,
+            seen,
+            roots=[self.test_data_path] * 3
+        )
+
+        self.assertEquals(results, [[self.view_path], [self.view_path], []])
+        self.assertEquals(seen.counters['listdir'], 4)
+
+        if scandir is not None:
+            self.assertTrue(cache.is_file(self.view_path, seen))
+            self.assertFalse(cache.is_file(os.path.dirname(self.view_path), seen))
+            self.assertFalse('isfile' in seen.counters)
+
+    def testDirectoriesCanBeReadInParallel(self):
+        self.setUpFilesForPyConfig()
+
+        cache = DirectoryCache()
+        cache.set_io_threads(4)
+        views_path = os.sep.join([self.test_data_path, 'application', 'views'])
+        patterns = [
+            os.sep.join([views_path, '*', '*']),
+            os.sep.join([self.test_data_path, 'application', '*', '*', '*.html'])
+        ]
+
+        try:
+            results = self.globTogether(patterns, cache, cache.begin_resolution())
+        finally:
+            cache.set_io_threads(0)
+
+        self.assertEquals(results, [[self.view_path], [self.template_path]])
+
+    def testDirectoriesOfFinishedPatternsAreNotReadInParallel(self):
+        self.setUpFilesForPyConfig()
+
+        cache = DirectoryCache()
+        cache.set_io_threads(4)
+        views_path = os.sep.join([self.test_data_path, 'application', 'views'])
+        patterns = [
+            os.sep.join([views_path, '*', '*']),
+            os.sep.join([self.test_data_path, 'application', 'templates', '*', '*.html'])
+        ]
+
+        seen = cache.begin_resolution()
+        try:
+            results = self.globTogether(patterns, cache, seen, finished=set([0]))
+        finally:
+            cache.set_io_threads(0)
+
+        self.assertEquals(results, [[], [self.template_path]])
+        self.assertFalse(views_path in seen)
+
+    def testMissingDirectoriesAreRememberedUntilCreated(self):
+        self.setUpFilesForPyConfig()
+        shutil.rmtree(os.sep.join([self.test_data_path, 'application', 'templates']))
+
+        def get_related_files():
+            file_selector = FileSelector(
+                sublime.active_window(),
+                self.settings_file,
+                self.view_path
+            )
+            return file_selector, file_selector.seen_directories.counters
+
+        file_selector, counters = get_related_files()
+        self.assertFalse('missing_cache_hits' in counters)
+
+        file_selector, counters = get_related_files()
+        self.assertEquals(counters['missing_cache_hits'], 1)
+        self.assertEquals(file_selector.related_files[1], ['Create template (bar.html)', self.template_path])
+
+        file_selector.select(1)
+        self.createFile(self.template_path)
+
+        file_selector, counters = get_related_files()
+        self.assertFalse('missing_cache_hits' in counters)
+        self.assertEquals(file_selector.related_files[1], ['Open template (bar.html)', self.template_path])
+
+    def testSymlinkedDirectoriesAreResolvedOncePerDirectory(self):
+        self.setUpFilesForPyConfig()
+        base_path = os.sep.join([self.test_data_path, 'application'])
+        real_templates_path = os.sep.join([base_path, 'real_templates'])
+        os.rename(os.sep.join([base_path, 'templates']), real_templates_path)
+        os.symlink(real_templates_path, os.sep.join([base_path, 'templates']))
+
+        def get_related_files():
+            file_selector = FileSelector(
+                sublime.active_window(),
+                self.settings_file,
+                self.view_path
+            )
+            return file_selector, resolution_stats.samples[-1]['counters']
+
+        file_selector, counters = get_related_files()
+        self.assertTrue(counters['realpath'] > 0)
+        self.assertEquals(
+            file_selector.related_files[1],
+            ['Open template (bar.html)', os.sep.join([real_templates_path, 'foo', 'bar.html'])]
+        )
+
+        file_selector, counters = get_related_files()
+        self.assertFalse('realpath' in counters)
+
+    def testInvalidatingADirectoryForgetsOnlyTheDirectoriesBelowIt(self):
+        self.setUpFilesForPyConfig()
+        base_path = os.sep.join([self.test_data_path, 'application'])
+        views_path = os.sep.join([base_path, 'views'])
+        nested_path = os.sep.join([views_path, 'foo'])
+        templates_path = os.sep.join([base_path, 'templates'])
+
+        normalizer = PathNormalizer()
+        for path in [nested_path, templates_path]:
+            normalizer.normalize_directory(path)
+
+        normalizer.invalidate(views_path)
+
+        counters = {}
+        normalizer.normalize_directory(templates_path, counters)
+        self.assertFalse('realpath' in counters)
+        normalizer.normalize_directory(nested_path, counters)
+        self.assertEquals(counters['realpath'], 1)
+
+    def testRelatedFilesUnderSymlinkedDirectoriesHaveRelatedFiles(self):
+        self.setUpFilesForPyConfig()
+        base_path = os.sep.join([self.test_data_path, 'application'])
+        real_templates_path = os.sep.join([base_path, 'real_templates'])
+        os.rename(os.sep.join([base_path, 'templates']), real_templates_path)
+        os.symlink(real_templates_path, os.sep.join([base_path, 'templates']))
+
+        file_selector = FileSelector(sublime.active_window(), self.settings_file, self.view_path)
+        template_path = [
+            path for label, path in file_selector.related_files
+            if label.startswith('Open template')
+        ][0]
+
+        file_selector = FileSelector(sublime.active_window(), self.settings_file, template_path)
+
+        self.assertEquals(
+            sorted([path for label, path in file_selector.related_files]),
+            [self.controller_path, self.view_path]
+        )
+
+    def testCompiledConfigurationIsReusedUntilSettingsChange(self):
+        settings = sublime.load_settings(self.settings_file)
+
+        compiled = configuration_cache.get(self.settings_file, settings)
+        self.assertTrue(configuration_cache.get(self.settings_file, settings) is compiled)
+
+        settings.set('enabled_configurations', ['js'])
+
+        recompiled = configuration_cache.get(self.settings_file, settings)
+        self.assertFalse(recompiled is compiled)
+        self.assertEquals([config.name for config in recompiled.configs], ['js'])
+
+    def testConfigurationDigestDependsOnlyOnConfigurations(self):
+        settings = sublime.load_settings(self.settings_file)
+
+        digest = CompiledConfiguration(settings, ['py']).digest
+        self.assertNotEquals(CompiledConfiguration(settings, ['js']).digest, digest)
+
+        settings.set('js', self.getPyConfig())
+        self.assertEquals(CompiledConfiguration(settings, ['py']).digest, digest)
+
+    def testSnapshotRestoresConfigurationsAndListings(self):
+        self.setUpFilesForPyConfig()
+
+        settings = sublime.load_settings(self.settings_file)
+        compiled = CompiledConfiguration(settings, ['py'])
+        listing_dir = os.path.dirname(self.template_path)
+        directory_cache.listing(listing_dir, directory_cache.begin_resolution())
+
+        snapshot_path = os.sep.join([self.test_data_path, 'snapshot.pickle'])
+        save_snapshot(snapshot_path, [compiled])
+        directory_cache.clear()
+
+        configurations = load_snapshot(snapshot_path)
+
+        self.assertEquals(list(configurations), [compiled.digest])
+        self.assertEquals(configurations[compiled.digest].match(self.view_path)[0].name, 'py')
+        self.assertEquals(
+            directory_cache.export_listings()[listing_dir].folded['bar.html'],
+            ['bar.html']
+        )
+
+    def startDaemon(self, settings=None):
+        if settings is None:
+            settings = sublime.load_settings(self.settings_file)
+        socket_path = os.sep.join([self.test_data_path, 'application', 'daemon.sock'])
+        daemon = ResolverDaemon(socket_path, settings, ['py'])
+
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.daemons.append((daemon, thread))
+
+        return socket_path
+
+    def testDaemonAnswersRequests(self):
+        self.setUpFilesForPyConfig()
+        socket_path = self.startDaemon()
+
+        response = request_daemon(socket_path, {'op': 'resolve', 'file': self.view_path, 'id': 1})
+        self.assertEquals(response['ok'], True)
+        self.assertEquals(response['id'], 1)
+        self.assertEquals(response['result']['file_type'], 'view')
+        self.assertEquals(
+            [related['path'] for related in response['result']['related']],
+            [self.controller_path, self.template_path]
+        )
+
+        response = request_daemon(
+            socket_path,
+            {'op': 'batch-resolve', 'files': [self.view_path, self.template_path]}
+        )
+        self.assertEquals(
+            [result['file_type'] for result in response['results']],
+            ['view', 'template']
+        )
+
+        self.assertEquals(request_daemon(socket_path, {'op': 'invalidate', 'path': None})['ok'], True)
+        self.assertTrue('Resolutions: ' in request_daemon(socket_path, {'op': 'stats'})['stats'])
+
+        response = request_daemon(socket_path, {'op': 'restart'})
+        self.assertEquals(response['ok'], False)
+        self.assertTrue('restart' in response['error'])
+
+        # Only the user running the daemon can connect to it.
+        self.assertEquals(os.stat(socket_path).st_mode & 0o777, 0o600)
+
+    def testDaemonRefusesRequestsForOtherConfigurations(self):
+        self.setUpFilesForPyConfig()
+        socket_path = self.startDaemon()
+        settings = sublime.load_settings(self.settings_file)
+        py_digest = CompiledConfiguration(settings, ['py']).digest
+        js_digest = CompiledConfiguration(settings, ['js']).digest
+
+        response = request_daemon(socket_path, {'op': 'resolve', 'file': self.view_path})
+        self.assertEquals(response['digest'], py_digest)
+
+        response = request_daemon(
+            socket_path,
+            {'op': 'resolve', 'file': self.view_path, 'digest': js_digest}
+        )
+        self.assertEquals(response['ok'], False)
+
+        response = request_daemon(
+            socket_path,
+            {'op': 'resolve', 'file': self.view_path, 'configurations': ['js'], 'digest': js_digest}
+        )
+        self.assertEquals(response['ok'], True)
+        self.assertEquals(response['result']['configuration'], None)
+
+        for configurations in ['py', [['py']]]:
+            response = request_daemon(
+                socket_path,
+                {'op': 'resolve', 'file': self.view_path, 'configurations': configurations}
+            )
+            self.assertEquals(response['ok'], False)
+
+    def testDaemonAppliesLimitsAndExcludePatterns(self):
+        self.setUpFilesForPyConfig()
+        socket_path = self.startDaemon()
+
+        response = request_daemon(socket_path, {
+            'op': 'resolve',
+            'file': self.controller_path,
+            'file_exclude_patterns': ['*.html']
+        })
+        self.assertEquals(
+            [related['path'] for related in response['result']['related']],
+            [self.view_path]
+        )
+
+        response = request_daemon(socket_path, {
+            'op': 'resolve',
+            'file': self.controller_path,
+            'max_results': 1
+        })
+        self.assertEquals(response['result']['truncated'], True)
+
+    def testFileSelectorAsksDaemonIfSet(self):
+        self.setUpFilesForPyConfig()
+        settings = sublime.load_settings(self.settings_file)
+        settings.set('daemon_socket', os.sep.join([self.test_data_path, 'application', 'missing.sock']))
+
+        file_selector = FileSelector(sublime.active_window(), self.settings_file, self.view_path)
+        expected_files = file_selector.related_files
+        self.assertEquals(len(expected_files), 2)
+
+        settings.set('daemon_socket', self.startDaemon())
+        resolution_stats.clear()
+
+        file_selector = FileSelector(sublime.active_window(), self.settings_file, self.view_path)
+
+        self.assertEquals(file_selector.related_files, expected_files)
+        # Only the daemon resolved them, not the file selector as well.
+        self.assertEquals(len(resolution_stats.samples), 1)
+
+    def testFileSelectorIgnoresDaemonWithOtherConfigurations(self):
+        self.setUpFilesForPyConfig()
+
+        config = self.getPyConfig()
+        config['file_types']['view']['rel_patterns']['template'] = \
+            '${app_path}/${type_path}/${file_from_type_path}.htm'
+        daemon_settings = {'py': config, 'js': self.getJsConfig()}
+
+        settings = sublime.load_settings(self.settings_file)
+        settings.set('enabled_configurations', ['js', 'py'])
+        settings.set('daemon_socket', self.startDaemon(daemon_settings))
+
+        file_selector = FileSelector(sublime.active_window(), self.settings_file, self.view_path)
+
+        self.assertEquals(
+            sorted(file_selector.related_files),
+            [
+                ['Open controller (foo.py)', self.controller_path],
+                ['Open template (bar.html)', self.template_path]
+            ]
+        )
+
+    def testProjectConfigurationsAreCompiledSeparately(self):
+        settings = sublime.load_settings(self.settings_file)
+
+        compiled = configuration_cache.get(self.settings_file, settings)
+        project_compiled = configuration_cache.get(self.settings_file, settings, ['py'])
+
+        self.assertEquals(len(compiled.configs), 3)
+        self.assertEquals([config.name for config in project_compiled.configs], ['py'])
+
+    def testConfigurationsAreMatchedInEnabledOrder(self):
+        settings = self.createDefaultSettings()
+        settings.set('enabled_configurations', ['js', 'py-no-controllers', 'py'])
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            os.sep.join(['path', 'to', 'application', 'views', 'view.php'])
+        )
+
+        self.assertEquals(
+            file_selector.configuration,
+            file_selector.settings.get('py-no-controllers')
+        )
+
+    def testModuleInAppDirIsTakenFromLeftmostMatch(self):
+        self.createJsSettingsWithTopLevelModules()
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            os.sep.join(['', 'js', 'admin', 'js', 'public', 'views', 'bar.js'])
+        )
+
+        self.assertEquals(file_selector.app_path, os.sep.join(['', 'js', 'admin']))
+
+    def testResolutionContextHoldsWildcardValuesOfCurrentFileType(self):
+        self.createJsSettingsWithModuleDirWithinTypePaths()
+        self.setUpFilesWithModuleDirWithinTypePaths()
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            self.admin_view_path
+        )
+
+        context = file_selector.resolver.get_context()
+        self.assertEquals(context.file_type, 'view')
+        self.assertEquals(context.wildcard_values, ('admin',))
+        self.assertEquals(context.template_vars['file_from_type_path'], os.sep.join(['foo', 'bar']))
+        self.assertRaises(AttributeError, setattr, context, 'file_type', 'controller')
+
+    def testRelatedFilesCanBeResolvedOnePatternAtATime(self):
+        self.setUpFilesForPyConfig()
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            self.view_path,
+            resolve=False
+        )
+
+        self.assertFalse(file_selector.files_found)
+
+        batches = list(file_selector.iter_related_files())
+        self.assertEquals(len(batches), 2)
+        self.assertEquals(
+            sorted(batch[0][1] for batch in batches),
+            sorted([self.controller_path, self.template_path])
+        )
+
+    def testCancelledResolutionStopsEarly(self):
+        self.setUpFilesForPyConfig()
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            self.view_path,
+            resolve=False
+        )
+
+        cancelled = threading.Event()
+        cancelled.set()
+
+        self.assertEquals(list(file_selector.iter_related_files(cancelled)), [])
+
+    def testResultsOfAPatternAreTruncatedAtTheLimit(self):
+        self.setUpFilesForPyConfig()
+
+        views_path = os.path.dirname(self.view_path)
+        for name in ['a.py', 'b.py', 'c.py']:
+            self.createFile(os.sep.join([views_path, name]))
+
+        sublime.load_settings(self.settings_file).set('max_related_files_per_pattern', 2)
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            self.controller_path
+        )
+
+        related_files = file_selector.related_files
+        self.assertTrue(file_selector.truncated)
+        self.assertEquals(
+            [label for label, path in related_files if path is None],
+            ['More view files not shown (truncated)']
+        )
+        self.assertEquals(len([path for label, path in related_files if path]), 3)
+
+        # Selecting the entry marking the truncation does nothing.
+        file_selector.select(related_files.index(['More view files not shown (truncated)', None]))
+
+    def testGlobbingStopsAtTheDeadline(self):
+        self.setUpFilesForPyConfig()
+
+        pattern = os.sep.join([self.test_data_path, 'application', '*', '*', '*'])
+        cache = DirectoryCache()
+
+        self.assertEquals(
+            list(iter_insensitive_globs([pattern], cache, cache.begin_resolution())),
+            [(0, self.view_path), (0, self.template_path)]
+        )
+        self.assertEquals(
+            list(iter_insensitive_globs(
+                [pattern],
+                cache,
+                cache.begin_resolution(),
+                deadline=time.time() - 1
+            )),
+            []
+        )
+
+    def testGlobbingReportsEachPatternWhenDone(self):
+        self.setUpFilesForPyConfig()
+
+        application_path = os.sep.join([self.test_data_path, 'application'])
+        cache = DirectoryCache()
+
+        self.assertEquals(
+            list(iter_insensitive_globs(
+                [
+                    os.sep.join([application_path, 'views', '*', '*']),
+                    os.sep.join([application_path, 'templates', '*', '*']),
+                    'relative' + os.sep + '*'
+                ],
+                cache,
+                cache.begin_resolution(),
+                report_done=True
+            )),
+            [(2, None), (0, self.view_path), (0, None), (1, self.template_path), (1, None)]
+        )
+
+    def testRelatedFilesOfEachPatternAreYieldedWhenItIsDone(self):
+        self.setUpFilesForPyConfig()
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            self.controller_path,
+            resolve=False
+        )
+        related_files = file_selector.iter_related_files()
+        expected_files = {
+            self.view_path: ['Open view (bar.py)', self.view_path],
+            self.template_path: ['Open template (bar.html)', self.template_path]
+        }
+
+        # The rel_patterns are in the order of the settings dict.
+        first_files = next(related_files)
+        self.assertEquals(len(first_files), 1)
+        first_path = first_files[0][1]
+        last_path = [path for path in expected_files if path != first_path][0]
+
+        self.assertEquals(first_files, [expected_files[first_path]])
+        self.assertFalse(os.path.dirname(last_path) in file_selector.seen_directories)
+        self.assertEquals(list(related_files), [[expected_files[last_path]]])
+
+    def testExcludedFoldersAreNotSearched(self):
+        self.setUpFilesForPyConfig()
+
+        cache = DirectoryCache()
+        seen = cache.begin_resolution()
+        application_path = os.sep.join([self.test_data_path, 'application'])
+
+        results = list(iter_insensitive_globs(
+            [os.sep.join([application_path, '*', 'foo', '*'])],
+            cache,
+            seen,
+            exclude=ExcludePatterns(['templ*'], ['*.html'])
+        ))
+
+        self.assertEquals(results, [(0, self.view_path)])
+        self.assertFalse(os.path.dirname(self.template_path) in seen)
+
+    def testExcludedFilesAreNotRelated(self):
+        self.setUpFilesForPyConfig()
+        self.createFile(self.view_path + 'c')
+
+        sublime.active_window().active_view().settings().set('file_exclude_patterns', ['*.pyc'])
+        try:
+            file_selector = FileSelector(
+                sublime.active_window(),
+                self.settings_file,
+                self.controller_path
+            )
+        finally:
+            sublime.active_window().active_view().settings().erase('file_exclude_patterns')
+
+        self.assertEquals(
+            sorted(path for label, path in file_selector.related_files),
+            sorted([self.view_path, self.template_path])
+        )
+
+    def testRelatedFilesCacheKeyChangesWithConfiguration(self):
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            os.sep.join(['path', 'to', 'application', 'views', 'view.php'])
+        )
+        cache_key = file_selector.cache_key
+
+        self.createSettingsWith1stPyConfigDisabled()
+
+        file_selector = FileSelector(
+            sublime.active_window(),
+            self.settings_file,
+            os.sep.join(['path', 'to', 'application', 'views', 'view.php'])
+        )
+
+        self.assertEquals(file_selector.cache_key[0], cache_key[0])
+        self.assertNotEquals(file_selector.cache_key, cache_key)
+
+    def testRelatedFilesCacheEvictsLeastRecentlyUsed(self):
+        cache = RelatedFilesCache(max_entries=4)
+
+        for i in range(4):
+            cache.set(('file%d' % i, 1), [['Open view (file%d)' % i, 'file%d' % i]])
+
+        cache.get(('file0', 1))
+        cache.set(('file4', 1), [])
+
+        self.assertNotEquals(cache.get(('file0', 1)), None)
+        self.assertEquals(cache.get(('file1', 1)), None)
+        self.assertEquals(cache.get(('file4', 1)), [])
+
+    def testRelatedFilesCacheIsKeptAcrossSessions(self):
+        os.makedirs(os.sep.join([self.test_data_path, 'application']))
+        path = os.sep.join([self.test_data_path, 'application', 'related_files.json'])
+        related_files = [['Open view (file0)', 'file0']]
+
+        cache = RelatedFilesCache(save_delay=60)
+        cache.load(path)
+        cache.set(('file0', 'digest'), related_files)
+
+        # Setting an entry doesn't write to disk at once.
+        self.assertFalse(os.path.exists(path))
+        cache.save()
+
+        cache = RelatedFilesCache()
+        self.assertEquals(cache.get(('file0', 'digest')), None)
+        cache.load(path)
+        self.assertEquals(cache.get(('file0', 'digest')), related_files)
+
+    def testDirectoryWatcherReportsNewFiles(self):
+        self.setUpFilesForPyConfig()
+
+        listing_dir = os.path.dirname(self.template_path)
+        changed = []
+
+        watcher = DirectoryWatcher(poll_interval=0.05)
+        watcher.add_listener(changed.append)
+        watcher.watch(listing_dir)
+
+        self.createFile(os.sep.join([listing_dir, 'baz.html']))
+
+        deadline = time.time() + 5
+        while listing_dir not in changed and time.time() < deadline:
+            watcher.sync()
+            time.sleep(0.01)
+        watcher.stop()
+
+        self.assertTrue(listing_dir in changed)
+
+    def testUnchangedWatchedDirectoriesAreNotStatted(self):
+        self.setUpFilesForPyConfig()
+
+        listing_dir = os.path.dirname(self.template_path)
+        an_hour_ago = time.time() - 3600
+        os.utime(listing_dir, (an_hour_ago, an_hour_ago))
+
+        cache = DirectoryCache()
+        cache.watcher = DirectoryWatcher(poll_interval=0.05)
+        stats = []
+        try:
+            for attempt in range(3):
+                seen = cache.begin_resolution()
+                cache.listing(listing_dir, seen)
+                stats.append(seen.counters.get('stat', 0))
+            watching = cache.watcher.is_watching(listing_dir)
+        finally:
+            cache.watcher.stop()
+
+        # Polled directories are checked every time.
+        if watching:
+            self.assertEquals(stats, [1, 1, 0])
+
+    def testEvictedDirectoriesAreNotWatched(self):
+        self.setUpFilesForPyConfig()
+
+        controllers_dir = os.path.dirname(self.controller_path)
+        templates_dir = os.path.dirname(self.template_path)
+
+        cache = DirectoryCache(max_entries=1)
+        cache.watcher = DirectoryWatcher(poll_interval=0.05)
+        try:
+            cache.listing(controllers_dir, cache.begin_resolution())
+            watched_before = cache.watcher.is_watching(controllers_dir)
+            cache.listing(templates_dir, cache.begin_resolution())
+            watched_after = cache.watcher.is_watching(controllers_dir)
+        finally:
+            cache.watcher.stop()
+
+        self.assertTrue(watched_before)
+        self.assertFalse(watched_after)
+
+    def testPathsSharingAWatchAreAllNotified(self):
+        self.setUpFilesForPyConfig()
+
+        listing_dir = os.path.dirname(self.template_path)
+        link_dir = os.sep.join([self.test_data_path, 'templates_link'])
+        if not hasattr(os, 'symlink'):
+            return
+        os.symlink(listing_dir, link_dir)
+
+        changed = []
+        watcher = DirectoryWatcher(poll_interval=0.05)
+        watcher.add_listener(changed.append)
+        try:
+            watcher.watch(listing_dir)
+            watcher.watch(link_dir)
+            watcher.unwatch(listing_dir)
+
+            self.createFile(os.sep.join([listing_dir, 'baz.html']))
+
+            deadline = time.time() + 5
+            while link_dir not in changed and time.time() < deadline:
+                watcher.sync()
+                time.sleep(0.01)
+        finally:
+            watcher.stop()
+
+        self.assertTrue(link_dir in changed)
+        self.assertFalse(listing_dir in changed)
+
+    def testDirectoriesStayWatchedUntilEveryOwnerUnwatchesThem(self):
+        self.setUpFilesForPyConfig()
+
+        listing_dir = os.path.dirname(self.template_path)
+        graph = object()
+
+        watcher = DirectoryWatcher(poll_interval=0.05)
+        try:
+            watcher.watch(listing_dir)
+            watcher.watch(listing_dir, graph)
+            watching = watcher.is_watching(listing_dir)
+            watcher.unwatch(listing_dir)
+            watching_for_graph = watcher.is_watching(listing_dir)
+            watcher.unwatch(listing_dir, graph)
+            watching_for_none = watcher.is_watching(listing_dir)
+        finally:
+            watcher.stop()
+
+        if watching:
+            self.assertTrue(watching_for_graph)
+            self.assertFalse(watching_for_none)
+
+    def testGitIndexListsTrackedAndUntrackedFiles(self):
+        self.setUpFilesForPyConfig()
+
+        if run_git(['init', '-q'], self.test_data_path) is None:
+            return
+
+        self.createFile(os.sep.join([self.test_data_path, '.gitignore']), '*.pyc\n')
+        self.createFile(self.view_path + 'c')
+        run_git(['add', self.controller_path, self.view_path], self.test_data_path)
+
+        source = GitIndexSource(self.test_data_path, os.sep.join([self.test_data_path, '.git']))
+        an_hour_ago = time.time() - 3600
+
+        def read(path, mtime):
+            return sorted(source.read(path, (mtime, 0)))
+
+        views_path = os.path.dirname(self.view_path)
+        templates_path = os.path.dirname(self.template_path)
+
+        self.assertEquals(read(views_path, an_hour_ago), ['bar.py'])
+        self.assertEquals(read(templates_path, an_hour_ago), ['bar.html'])
+
+        # Directories changed since git was asked are listed.
+        self.assertEquals(read(views_path, time.time()), ['bar.py', 'bar.pyc'])
+
+        # Untracked files are not asked for again when the index changes, so
+        # a new one is only found once its directory is seen to change.
+        self.createFile(os.sep.join([templates_path, 'baz.html']))
+        run_git(['add', self.template_path], self.test_data_path)
+
+        self.assertEquals(read(templates_path, an_hour_ago), ['bar.html'])
+        self.assertEquals(read(templates_path, time.time()), ['bar.html', 'baz.html'])
+
+    def testGitIndexListsNonAsciiNames(self):
+        self.setUpFilesForPyConfig()
+
+        views_path = os.path.dirname(os.path.dirname(self.view_path))
+        if not isinstance(views_path, type(u'')):
+            views_path = views_path.decode('utf-8')
+        directory = os.path.join(views_path, u'caf\xe9')
+
+        try:
+            os.makedirs(directory)
+        except UnicodeError:
+            # The filesystem encoding can't encode the name.
+            return
+
+        if run_git(['init', '-q'], self.test_data_path) is None:
+            return
+
+        self.createFile(os.path.join(directory, u'bar.py'))
+        run_git(['add', '.'], self.test_data_path)
+
+        source = GitIndexSource(self.test_data_path, os.sep.join([self.test_data_path, '.git']))
+        self.assertEquals(source.read(views_path, (time.time() - 3600, 0)), [u'caf\xe9', u'foo'])
+        self.assertEquals(source.read(directory, (time.time() - 3600, 0)), [u'bar.py'])
+
+    def testPathTrieListsDirectories(self):
+        trie = PathTrie([
+            'application/views/foo/bar.py',
+            'application/views/foo/Bar.html',
+            'application/views/Foo/baz.py',
+            'README.md'
+        ])
+
+        self.assertEquals(trie.file_count, 4)
+        self.assertEquals(trie.listing('.'), ['README.md', 'application'])
+        self.assertEquals(trie.listing(os.sep.join(['application', 'views'])), ['Foo', 'foo'])
+        self.assertEquals(trie.listing(os.sep.join(['application', 'views', 'bar'])), None)
+        self.assertEquals(trie.listing('README.md'), None)
+        self.assertEquals(
+            trie.listing(os.sep.join(['application', 'views', 'foo'])),
+            ['Bar.html', 'bar.py']
+        )
+        self.assertTrue(trie.memory_footprint() > 0)
+
+    def testRelatedFilesCacheDropsEntriesWhoseDirectoriesChange(self):
+        cache = RelatedFilesCache()
+        cache.set(('foo', 1), [], ['/app/views', '/app/templates'])
+        cache.set(('bar', 1), [], ['/app/views'])
+
+        cache.invalidate_directory('/app/templates')
+
+        self.assertEquals(cache.get(('foo', 1)), None)
+        self.assertEquals(cache.get(('bar', 1)), [])
+
+    def testRelatedFilesCanBeResolvedWithoutSublime(self):
+        self.setUpFilesForPyConfig()
+
+        compiled_configuration = CompiledConfiguration(
+            {'py': self.getPyConfig()},
+            ['py']
+        )
+
+        result = resolve(compiled_configuration, self.view_path)
+
+        self.assertEquals(result['configuration'], 'py')
+        self.assertEquals(result['file_type'], 'view')
+        self.assertEquals(
+            sorted(related['path'] for related in result['related']),
+            sorted([self.controller_path, self.template_path])
+        )
+        self.assertTrue(result['related'][0]['exists'])
+
+    def testGlobPlansAddPrefixAndSuffixToFileName(self):
+        plan = GlobPlan(
+            'test',
+            '$full_type_path/${file_from_type_path}.py',
+            {'path': 'tests/{%}', 'prefix': 'test_', 'suffix': '_spec'}
+        )
+        variables = {
+            'app_path': os.sep + 'app',
+            'full_type_path': os.sep.join(['', 'app', 'tests', 'unit']),
+            'file_from_type_path': os.sep.join(['foo', 'bar'])
+        }
+
+        self.assertTrue(plan.anchored)
+        self.assertEquals(plan.type_path(['unit']), os.sep.join(['tests', 'unit']))
+        self.assertEquals(
+            plan.substitute(variables),
+            os.sep.join(['', 'app', 'tests', 'unit', 'foo', 'test_bar_spec.py'])
+        )
+
+        plan = GlobPlan('test', '$$1/$unknown/*', {'path': 'tests', 'prefix': 'test_'})
+
+        self.assertFalse(plan.anchored)
+        self.assertEquals(plan.substitute(variables), os.sep.join(['$1', '$unknown', '*']))
+
+    def testRelatedFileGraphIncludesReverseAndTransitiveRelations(self):
+        self.setUpFilesForPyConfig()
+
+        config = self.getPyConfig()
+        del config['file_types']['template']['rel_patterns']['controller']
+        graph = RelatedFileGraph(CompiledConfiguration({'py': config}, ['py']))
+        resolution_stats.clear()
+        graph.scan([self.test_data_path])
+        self.assertEquals(len(resolution_stats.samples), 0)
+
+        # The template has no rel_pattern for controllers, but the
+        # controller's rel_patterns match the template.
+        self.assertEquals(
+            graph.get_related_files(self.template_path),
+            [
+                ['Open view (bar.py)', self.view_path],
+                ['Open controller (foo.py)', self.controller_path]
+            ]
+        )
+        self.assertEquals(
+            sorted(path for label, path in graph.get_transitively_related_files(self.controller_path, 1)),
+            sorted([self.view_path, self.template_path])
+        )
+
+    def testRelatedFileGraphFollowsDirectoryChanges(self):
+        self.setUpFilesForPyConfig()
+
+        graph = RelatedFileGraph(CompiledConfiguration({'py': self.getPyConfig()}, ['py']))
+        graph.scan([self.test_data_path])
+
+        os.remove(self.template_path)
+        graph.directory_changed(os.path.dirname(self.template_path))
+
+        self.assertEquals(
+            graph.get_related_files(self.view_path)[1],
+            ['Create template (bar.html)', self.template_path]
+        )
+        self.assertEquals(
+            graph.get_transitively_related_files(self.controller_path),
+            [['Open view (bar.py)', self.view_path]]
+        )
+
+        self.createFile(self.template_path)
+        graph.directory_changed(os.path.dirname(self.template_path))
+
+        self.assertEquals(
+            graph.get_related_files(self.view_path)[1],
+            ['Open template (bar.html)', self.template_path]
+        )
+
+    def testEachWindowKeepsOneRelatedFileGraph(self):
+        self.setUpFilesForPyConfig()
+        window = sublime.active_window()
+        settings = sublime.load_settings(self.settings_file)
+
+        try:
+            selector = FileSelector(window, self.settings_file, self.view_path, resolve=False)
+            graph = get_related_file_graph(window, selector)
+            self.assertTrue(get_related_file_graph(window, selector) is graph)
+
+            settings.set('enabled_configurations', ['py'])
+            selector = FileSelector(window, self.settings_file, self.view_path, resolve=False)
+            new_graph = get_related_file_graph(window, selector)
+
+            self.assertFalse(new_graph is graph)
+            self.assertEquals(len(related_file_graphs), 1)
+            if directory_cache.watcher is not None:
+                self.assertFalse(graph.directory_changed in directory_cache.watcher.listeners)
+                self.assertTrue(new_graph.directory_changed in directory_cache.watcher.listeners)
+        finally:
+            for key, graph in related_file_graphs.values():
+                if directory_cache.watcher is not None:
+                    directory_cache.watcher.remove_listener(graph.directory_changed)
+            related_file_graphs.clear()
+
+    def testRelatedFileGraphWalksAndWatchesNewDirectories(self):
+        self.setUpFilesForPyConfig()
+
+        config = self.getPyConfig()
+        del config['file_types']['template']['rel_patterns']['controller']
+        controllers_dir = os.path.dirname(self.controller_path)
+        template_dir = os.sep.join([self.test_data_path, 'application', 'templates', 'admin', 'users'])
+        os.makedirs(template_dir)
+        template_path = os.sep.join([template_dir, 'index.html'])
+        self.createFile(template_path)
+
+        cache = DirectoryCache()
+        cache.watcher = DirectoryWatcher(poll_interval=0.05)
+        graph = RelatedFileGraph(CompiledConfiguration({'py': config}, ['py']), cache)
+        try:
+            graph.scan([self.test_data_path])
+            watching = cache.watcher.is_watching(controllers_dir)
+
+            os.makedirs(os.sep.join([controllers_dir, 'admin']))
+            controller_path = os.sep.join([controllers_dir, 'admin', 'users.py'])
+            self.createFile(controller_path)
+            graph.directory_changed(controllers_dir)
+
+            related_files = graph.get_related_files(template_path)
+            watching_new_directory = cache.watcher.is_watching(os.path.dirname(controller_path))
+        finally:
+            cache.watcher.stop()
+
+        self.assertTrue(['Open controller (users.py)', controller_path] in related_files)
+
+        # Polled directories are not reported as watched.
+        if watching:
+            self.assertTrue(watching_new_directory)
+
+    def testSettingsFilesMayContainCommentsAndTrailingCommas(self):
+        os.makedirs(os.sep.join([self.test_data_path, 'application']))
+        settings_path = os.sep.join([self.test_data_path, 'application', 'test.sublime-settings'])
+        self.createFile(
+            settings_path,
+            '{\n'
+            '    // Comment\n'
+            '    "enabled_configurations": ["py", /* inline */ "js",],\n'
+            '    "url": "http://example.com/*not a comment*/",\n'
+            '}\n'
+        )
+
+        settings = load_settings_file(settings_path)
+
+        self.assertEquals(settings['enabled_configurations'], ['py', 'js'])
+        self.assertEquals(settings['url'], 'http://example.com/*not a comment*/')
+
+    def testResolutionsAreRecordedWithTimingsAndCounters(self):
+        self.setUpFilesForPyConfig()
+        resolution_stats.clear()
+
+        FileSelector(sublime.active_window(), self.settings_file, self.view_path)
+
+        sample = resolution_stats.samples[-1]
+        self.assertEquals(sample['file'], self.view_path)
+        for phase in ResolutionStats.PHASES:
+            self.assertTrue(phase in sample['timings'])
+        self.assertTrue(sample['counters']['realpath'] > 0)
+
+        report = resolution_stats.format()
+        self.assertTrue('Resolutions: 1 ' in report)
+        self.assertTrue('globbing' in report)
+
+    def testResolutionStatsAreAppendedToLogFile(self):
+        os.makedirs(os.sep.join([self.test_data_path, 'application']))
+        log_file = os.sep.join([self.test_data_path, 'application', 'stats.jsonl'])
+
+        stats = ResolutionStats()
+        stats.log_file = log_file
+        stats.record('foo.py', {'globbing': 0.5}, {'stat': 2})
+        stats.record('bar.py', {'globbing': 0.25}, {'stat': 1})
+
+        lines = open(log_file).read().splitlines()
+        self.assertEquals(len(lines), 2)
+        self.assertTrue('"file": "bar.py"' in lines[1])
+        self.assertTrue('"total": 0.25' in lines[1])
@@ -0,0 +1,3239 @@
+"""
+    The resolution engine behind GotoRelatedFile, independent of Sublime Text.
+
+    Run as a script, it resolves the related files of a list of files, or of
+    every file in a directory, with the configurations from a settings file,
+    and prints one JSON object per file:
+
+        python related_file_resolver.py --settings GotoRelatedFile.sublime-settings \\
+            --dir path/to/project --jobs 8
+
+    With --daemon it instead keeps its caches warm in a long-lived process
+    that answers requests on a Unix socket; see ResolverDaemon.
+"""
+import os
+import re
+import bisect
+import glob
+import fnmatch
+import threading
+import time
+import hashlib
+import platform
+import struct
+import select
+import signal
+import socket
+import json
+import optparse
+import pickle
+import subprocess
+import sys
+import collections
+import itertools
+from string import Template
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # The backport for Pythons older than 3.5, if it is installed.
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    ThreadPool = None
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class DirectoryCache(object):
+    """
+        Cache of directory listings, with the names in each directory indexed
+        by their lower-cased form so that case-insensitive lookups need at most
+        one listdir per directory.
+
+        Listings are reused across resolutions.  A cached listing is checked
+        against the directory's mtime the first time it is used in a
+        resolution, unless a DirectoryWatcher is watching the directory for
+        changes.  The least recently used listings are evicted once
+        max_entries is exceeded.
+
+        The cache also remembers paths found not to exist, keyed by their
+        parent, so that lookups under them stop at the first missing
+        directory for as long as its parent's listing still lacks it.
+    """
+
+    # Listings taken within this many seconds of the directory's mtime are
+    # not trusted, since a file created in the same mtime tick would not
+    # change the mtime again.
+    RACY_INTERVAL = 2
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self.sources = []
+        self.watcher = None
+        self._listings = {}
+        self._missing = {}
+        self._lock = threading.Lock()
+        self._tick = 0
+        self._io_threads = 0
+        self._io_pool = None
+
+    def set_io_threads(self, io_threads):
+        """
+        Read directories on a pool of io_threads threads, or one at a time
+        in the resolving thread if io_threads is less than 2.
+        """
+        if ThreadPool is None or io_threads < 2:
+            io_threads = 0
+
+        with self._lock:
+            io_pool = self._io_pool
+            if io_threads == self._io_threads:
+                return
+
+            self._io_threads = io_threads
+            self._io_pool = io_threads and ThreadPool(io_threads) or None
+
+        if io_pool is not None:
+            io_pool.close()
+
+    @property
+    def parallel(self):
+        return self._io_pool is not None
+
+    def listings(self, paths, seen):
+        """
+        Get the DirectoryListing of each of paths, reading them in parallel
+        if there is an I/O pool.
+        """
+        io_pool = self._io_pool
+        if io_pool is None or len(paths) < 2:
+            return [self.listing(path, seen) for path in paths]
+
+        return io_pool.map(lambda path: self.listing(path, seen), paths)
+
+    def begin_resolution(self):
+        """
+        Start a resolution, returning the ResolutionState to pass to
+        listing() during it.
+        """
+        if self.watcher is not None:
+            self.watcher.sync()
+
+        return ResolutionState()
+
+    def listing(self, path, seen):
+        """
+        Get the DirectoryListing for path, or None if path is not a readable
+        directory.
+
+        :Args:
+            - path: absolute path of the directory
+            - seen: ResolutionState of the current resolution, holding the
+              listings already validated during it
+
+        """
+        if path in seen:
+            return seen[path]
+
+        with self._lock:
+            self._tick += 1
+            cached = self._listings.get(path)
+
+            # The watcher drops the listing of a watched directory as soon as
+            # it changes, so there is no need to check its mtime.
+            if cached and cached.watched:
+                cached.last_used = self._tick
+                seen.count('listing_cache_hits')
+                seen[path] = cached
+                return cached
+
+        seen.count('stat')
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            seen[path] = None
+            return None
+
+        signature = (stat.st_mtime, stat.st_ino)
+
+        watcher = self.watcher
+        watched = watcher is not None and watcher.is_watching(path)
+
+        if cached and cached.signature == signature and not cached.racy:
+            with self._lock:
+                cached.last_used = self._tick
+                # The directory has not changed since the watch was put in
+                # place, so the watcher will drop the listing if it does.
+                if watched:
+                    cached.watched = True
+            seen.count('listing_cache_hits')
+            seen[path] = cached
+            return cached
+
+        seen.count('listing_cache_misses')
+
+        seen.count('listdir')
+        try:
+            names, files, links = self._read(path, signature)
+        except OSError:
+            self.invalidate(path)
+            seen[path] = None
+            return None
+
+        listing = DirectoryListing(
+            names,
+            signature,
+            time.time() - stat.st_mtime < self.RACY_INTERVAL,
+            files,
+            links
+        )
+        listing.watched = watched
+
+        evicted = ()
+        with self._lock:
+            listing.last_used = self._tick
+            self._listings[path] = listing
+            if len(self._listings) > self.max_entries:
+                evicted = self._evict()
+
+        if watcher is not None:
+            # Directories no longer cached need not be watched.
+            for evicted_path in evicted:
+                watcher.unwatch(evicted_path)
+
+            if not watched:
+                watcher.watch(path)
+
+        seen[path] = listing
+        return listing
+
+    def is_file(self, path, seen):
+        """
+        Whether path is a file, answered from the directory entry in the
+        listing of its parent read during this resolution when possible.
+        """
+        parent, name = os.path.split(path)
+        listing = seen.get(parent)
+
+        if listing is not None and listing.files is not None \
+                and name not in listing.links:
+            return name in listing.files
+
+        seen.count('isfile')
+        return os.path.isfile(path)
+
+    def export_listings(self):
+        """
+        Get the cached listings, keyed by path.
+        """
+        with self._lock:
+            return dict(self._listings)
+
+    def import_listings(self, listings):
+        """
+        Add listings exported by another cache, keeping any listing already
+        cached for the same path.  They are checked against the mtime of
+        their directory when first used, like any other listing that is not
+        watched.
+        """
+        with self._lock:
+            for path, listing in listings.items():
+                if path not in self._listings and len(self._listings) < self.max_entries:
+                    listing.watched = False
+                    listing.last_used = 0
+                    self._listings[path] = listing
+
+    def memory_footprint(self):
+        """
+        Get the approximate number of bytes the cached listings take up.
+        """
+        with self._lock:
+            listings = list(self._listings.values())
+
+        size = sys.getsizeof(self._listings)
+        for listing in listings:
+            size += sys.getsizeof(listing) + sys.getsizeof(listing.names) \
+                + sys.getsizeof(listing.folded)
+            size += sum([sys.getsizeof(name) for name in listing.names])
+
+        return size
+
+    def add_source(self, source):
+        """
+        Add a listing source, which is asked for the names in the directories
+        it handles before falling back to os.listdir.  A source must provide
+        handles(path) and read(path, signature), where signature is the
+        directory's current (mtime, inode).
+        """
+        with self._lock:
+            self.sources.append(source)
+
+    def find_missing(self, path, seen):
+        """
+        Get the deepest of path and its ancestors that is known not to
+        exist, or None if none is.
+        """
+        ancestor = path
+        while True:
+            parent, name = os.path.split(ancestor)
+            if parent == ancestor or not name:
+                seen.count('missing_cache_misses')
+                return None
+
+            folded_name = name.lower()
+            if folded_name in self._missing.get(parent, ()):
+                listing = self.listing(parent, seen)
+                if listing is not None and folded_name not in listing.folded:
+                    seen.count('missing_cache_hits')
+                    return ancestor
+
+                with self._lock:
+                    self._missing.get(parent, set()).discard(folded_name)
+
+            ancestor = parent
+
+    def record_missing(self, path, seen):
+        """
+        Remember the deepest of path and its ancestors that does not exist,
+        judging by the listings read during this resolution.  Nothing is
+        recorded unless the listing of its parent was read.
+        """
+        if seen.get(path) is not None:
+            return
+
+        missing = path
+        parent = os.path.dirname(path)
+        while parent != missing:
+            listing = seen.get(parent)
+            if listing is not None:
+                folded_name = os.path.basename(missing).lower()
+                if folded_name not in listing.folded:
+                    with self._lock:
+                        if len(self._missing) >= self.max_entries:
+                            self._missing.clear()
+                        self._missing.setdefault(parent, set()).add(folded_name)
+                return
+
+            missing, parent = parent, os.path.dirname(parent)
+
+    def invalidate(self, path):
+        with self._lock:
+            self._listings.pop(path, None)
+            self._missing.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+            self._missing.clear()
+
+    def _read(self, path, signature):
+        """
+        Read the names in path, along with the names of its regular files
+        and of its symbolic links if the directory entries tell them apart,
+        or None for both if they do not.
+        """
+        for source in self.sources:
+            if source.handles(path):
+                return source.read(path, signature), None, None
+
+        if scandir is None:
+            return os.listdir(path), None, None
+
+        names = []
+        files = []
+        links = []
+        for entry in scandir(path):
+            names.append(entry.name)
+            if entry.is_symlink():
+                # What a link points to may change without its directory
+                # changing, so links are checked when they are matched.
+                links.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+
+        return names, frozenset(files), frozenset(links)
+
+    def _evict(self):
+        """
+        Drop the least recently used quarter of the listings, returning
+        their paths.  Called with the lock held.
+        """
+        by_age = sorted(self._listings.items(), key=lambda item: item[1].last_used)
+        evicted = [path for path, listing in by_age[:len(by_age) // 4 or 1]]
+        for path in evicted:
+            del self._listings[path]
+
+        return evicted
+
+
+class PathNormalizer(object):
+    """
+        Resolves symbolic links in paths the way os.path.realpath does, but
+        resolves each directory only once.  normalize() resolves a path by
+        looking up the resolved form of its parent directory, so the path's
+        last component is not resolved itself unless it is '.' or '..';
+        normalize_directory() resolves a directory's path in full.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._directories = {}
+        # The paths directly below each directory that have an entry, or
+        # have entries below them, so a directory's entries can be found
+        # without going through all of them.
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def normalize(self, path, counters=None):
+        """
+            Get path with the symbolic links in its directory resolved,
+            counting any call to os.path.realpath in counters.
+        """
+        parent, name = os.path.split(path)
+        if name in ('', '.', '..'):
+            return self.normalize_directory(path, counters)
+
+        return os.path.join(self.normalize_directory(parent, counters), name)
+
+    def normalize_directory(self, path, counters=None):
+        """
+            Get the real path of the directory at path.
+        """
+        with self._lock:
+            real_path = self._directories.get(path)
+        if real_path is not None:
+            return real_path
+
+        if counters is not None:
+            counters['realpath'] = counters.get('realpath', 0) + 1
+
+        real_path = os.path.realpath(path)
+        with self._lock:
+            if len(self._directories) >= self.max_entries:
+                self._directories.clear()
+                self._children.clear()
+            self._directories[path] = real_path
+            self._add_child(path)
+
+        return real_path
+
+    def invalidate(self, path):
+        """
+            Forget the directory at path and every directory below it.
+        """
+        root = path.rstrip(os.sep) or os.sep
+        with self._lock:
+            stack = [path, root]
+            while stack:
+                directory = stack.pop()
+                self._directories.pop(directory, None)
+                stack.extend(self._children.pop(directory, ()))
+
+            siblings = self._children.get(os.path.dirname(root))
+            if siblings is not None:
+                siblings.discard(root)
+
+    def clear(self):
+        with self._lock:
+            self._directories.clear()
+            self._children.clear()
+
+    def _add_child(self, path):
+        """
+            Link path to its parent, and any ancestors not linked yet to
+            theirs.  Called with the lock held.
+        """
+        while True:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return
+
+            children = self._children.get(parent)
+            if children is not None:
+                children.add(path)
+                return
+
+            self._children[parent] = set([path])
+            path = parent
+
+
+path_normalizer = PathNormalizer()
+
+
+class ResolutionState(dict):
+    """
+        The directory listings validated during one resolution, keyed by
+        path, along with counts of the filesystem operations and cache
+        lookups made during it.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+
+class DirectoryListing(object):
+
+    __slots__ = (
+        'names',
+        'folded',
+        'files',
+        'links',
+        'signature',
+        'racy',
+        'watched',
+        'last_used'
+    )
+
+    def __init__(self, names, signature, racy, files=None, links=None):
+        self.names = names
+        self.files = files
+        self.links = links
+        self.signature = signature
+        self.racy = racy
+        self.watched = False
+        self.last_used = 0
+        self.folded = {}
+        for name in names:
+            self.folded.setdefault(name.lower(), []).append(name)
+
+
+directory_cache = DirectoryCache()
+
+
+class DirectoryWatcher(object):
+    """
+        Watches directories for changes to their listings, and calls each
+        listener with the path of a directory that changed, or None if
+        changes may have been missed and every directory should be
+        considered changed.
+
+        Uses inotify on Linux.  Directories that cannot be watched with
+        inotify, on other platforms or once max_watches is reached, are
+        polled for changes to their mtime every poll_interval seconds
+        instead.  Paths that are the same directory, such as a symbolic link
+        and its target, share an inotify watch.  A path stays watched until
+        each owner that asked for it to be watched unwatches it.
+    """
+
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+        IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    def __init__(self, max_watches=4096, poll_interval=2.0):
+        self.max_watches = max_watches
+        self.poll_interval = poll_interval
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._watched_paths = {}
+        self._polled_paths = {}
+        self._owners = {}
+        self._polling_thread = None
+        self._stopped = threading.Event()
+        self._inotify = None
+        self._inotify_fd = None
+        self._watch_descriptors = {}
+        self._read_lock = threading.Lock()
+
+        if platform.system() == 'Linux' and ctypes is not None:
+            self._start_inotify()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def is_watching(self, path):
+        """
+        Whether changes to path are reported as they happen, rather than by
+        polling.
+        """
+        return path in self._watched_paths
+
+    def watch(self, path, owner=None):
+        with self._lock:
+            self._owners.setdefault(path, set()).add(owner)
+            if path in self._watched_paths or path in self._polled_paths:
+                return
+
+            if self._inotify is not None and len(self._watched_paths) < self.max_watches:
+                encoded_path = path if isinstance(path, bytes) else path.encode('utf-8')
+                wd = self._inotify.inotify_add_watch(
+                    self._inotify_fd,
+                    encoded_path,
+                    self.WATCH_MASK
+                )
+                if wd >= 0:
+                    self._watched_paths[path] = wd
+                    self._watch_descriptors.setdefault(wd, set()).add(path)
+                    return
+
+            if len(self._polled_paths) >= self.max_watches:
+                return
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return
+
+            self._polled_paths[path] = (stat.st_mtime, stat.st_ino)
+
+            if self._polling_thread is None:
+                self._polling_thread = threading.Thread(target=self._poll)
+                self._polling_thread.daemon = True
+                self._polling_thread.start()
+
+    def unwatch(self, path, owner=None):
+        """
+        Stop watching path for owner, and once no owner is left, stop
+        watching it at all, removing its inotify watch unless another path
+        shares it.
+        """
+        with self._lock:
+            owners = self._owners.get(path)
+            if owners:
+                owners.discard(owner)
+                if owners:
+                    return
+
+            self._owners.pop(path, None)
+            self._polled_paths.pop(path, None)
+
+            wd = self._watched_paths.pop(path, None)
+            if wd is None:
+                return
+
+            paths = self._watch_descriptors.get(wd, set())
+            paths.discard(path)
+            if not paths:
+                self._watch_descriptors.pop(wd, None)
+                self._inotify.inotify_rm_watch(self._inotify_fd, wd)
+
+    def stop(self):
+        self._stopped.set()
+        with self._read_lock:
+            if self._inotify_fd is not None:
+                os.close(self._inotify_fd)
+                self._inotify_fd = None
+
+    def _notify(self, path):
+        for listener in list(self.listeners):
+            listener(path)
+
+    def _start_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(self.IN_CLOEXEC | self.IN_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+
+        if fd < 0:
+            return
+
+        self._inotify = libc
+        self._inotify_fd = fd
+
+        thread = threading.Thread(target=self._read_inotify_events)
+        thread.daemon = True
+        thread.start()
+
+    def _read_inotify_events(self):
+        while not self._stopped.is_set():
+            try:
+                select.select([self._inotify_fd], [], [], 1.0)
+            except (select.error, TypeError, ValueError):
+                return
+
+            self.sync()
+
+    def sync(self):
+        """
+        Report the changes inotify has queued so far.  Called at the start
+        of each resolution, so that no change made before it can be missed
+        while the reading thread is yet to wake up.
+        """
+        if self._inotify_fd is None:
+            return
+
+        with self._read_lock:
+            while True:
+                try:
+                    data = os.read(self._inotify_fd, 64 * 1024)
+                except (OSError, TypeError):
+                    return
+
+                if not data:
+                    return
+
+                self._handle_inotify_events(data)
+
+    def _handle_inotify_events(self, data):
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += 16 + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                self._notify(None)
+                continue
+
+            with self._lock:
+                paths = list(self._watch_descriptors.get(wd, ()))
+                if mask & self.IN_IGNORED:
+                    self._watch_descriptors.pop(wd, None)
+                    for path in paths:
+                        self._watched_paths.pop(path, None)
+
+            for path in paths:
+                self._notify(path)
+
+    def _poll(self):
+        while True:
+            self._stopped.wait(self.poll_interval)
+            if self._stopped.is_set():
+                return
+
+            with self._lock:
+                polled_paths = list(self._polled_paths.items())
+
+            for path, signature in polled_paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    with self._lock:
+                        self._polled_paths.pop(path, None)
+                    self._notify(path)
+                    continue
+
+                if (stat.st_mtime, stat.st_ino) != signature:
+                    with self._lock:
+                        self._polled_paths[path] = (stat.st_mtime, stat.st_ino)
+                    self._notify(path)
+
+
+class PathTrieNode(object):
+    """
+        A directory in a PathTrie: the names in it, sorted, and for each the
+        node of the subdirectory it names, or None for a file.  children is
+        None if the directory has only files.
+    """
+
+    __slots__ = ('names', 'children')
+
+    def __init__(self, names, children):
+        self.names = names
+        self.children = children
+
+    def index(self, name):
+        position = bisect.bisect_left(self.names, name)
+        if position < len(self.names) and self.names[position] == name:
+            return position
+
+        return -1
+
+
+class PathTrie(object):
+    """
+        Compact index of the files under a directory, given by their paths
+        relative to it with '/' separators.
+
+        Every path component is stored once, however many directories it
+        appears in, and each directory is a node holding sorted tuples of
+        the names in it and their nodes, rather than a string for every
+        path.  Case-insensitive lookups are left to the DirectoryListing
+        made from a directory's names.
+    """
+
+    def __init__(self, file_paths):
+        components = {}
+        tree = {}
+
+        for file_path in file_paths:
+            if not file_path:
+                continue
+
+            node = tree
+            names = file_path.split('/')
+            for name in names[:-1]:
+                name = components.setdefault(name, name)
+                child = node.get(name)
+                if child is None:
+                    child = node[name] = {}
+                node = child
+
+            name = components.setdefault(names[-1], names[-1])
+            node.setdefault(name, None)
+
+        self.file_count = 0
+        self.root = self._freeze(tree)
+
+        self._component_count = len(components)
+        self._components_size = sum([sys.getsizeof(name) for name in components])
+
+    def _freeze(self, tree):
+        names = tuple(sorted(tree))
+        children = []
+        for name in names:
+            child = tree[name]
+            if child is None:
+                self.file_count += 1
+                children.append(None)
+            else:
+                children.append(self._freeze(child))
+
+        if not [child for child in children if child is not None]:
+            return PathTrieNode(names, None)
+
+        return PathTrieNode(names, tuple(children))
+
+    def directory(self, relative_path):
+        """
+            Get the node of the directory at relative_path, which is '.' or
+            uses os.sep, or None if there is none.
+        """
+        node = self.root
+        if relative_path == '.':
+            return node
+
+        for name in relative_path.split(os.sep):
+            position = node.index(name)
+            if position == -1 or node.children is None:
+                return None
+
+            node = node.children[position]
+            if node is None:
+                return None
+
+        return node
+
+    def listing(self, relative_path):
+        """
+            Get the names in the directory at relative_path, or None if
+            there is no such directory.
+        """
+        node = self.directory(relative_path)
+        return None if node is None else list(node.names)
+
+    def memory_footprint(self):
+        """
+            Get the approximate number of bytes the trie takes up.
+        """
+        size = self._components_size
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            size += sys.getsizeof(node) + sys.getsizeof(node.names)
+            if node.children is not None:
+                size += sys.getsizeof(node.children)
+                nodes += [child for child in node.children if child is not None]
+
+        return size
+
+
+class GitIndexSource(object):
+    """
+        Listing source that answers from the files git knows about in a work
+        tree: the files in its index, from git ls-files, along with the
+        untracked files it does not ignore.  The files in the index are read
+        from git when a listing is first needed, and again whenever the mtime
+        of the index changes, which reading the index is cheap enough for.
+        The untracked files, which git has to walk the work tree to find,
+        are only read from git when a listing is first needed.
+
+        Directories git has nothing in, such as ignored ones, and
+        directories that have changed since git was asked are listed with
+        os.listdir, which also finds the untracked files created or deleted
+        since.  The files are kept in PathTries.
+    """
+
+    def __init__(self, root, git_dir):
+        self.root = root.rstrip(os.sep) or os.sep
+        self.index_path = os.path.join(git_dir, 'index')
+        self._lock = threading.Lock()
+        self._index_mtime = None
+        self._listed_at = 0
+        self._trie = PathTrie(())
+        self._untracked_listed_at = None
+        self._untracked_trie = None
+
+    def handles(self, path):
+        return path == self.root or path.startswith(self.root.rstrip(os.sep) + os.sep)
+
+    def read(self, path, signature):
+        trie, untracked_trie, listed_at = self._load()
+
+        relative_path = os.path.relpath(path, self.root)
+        names = trie.listing(relative_path)
+        untracked_names = untracked_trie.listing(relative_path)
+        if names is None:
+            names = untracked_names
+        elif untracked_names:
+            names = sorted(set(names + untracked_names))
+
+        # A directory changed within RACY_INTERVAL of asking git may have
+        # changed after git was asked.
+        if names is None or signature[0] > listed_at - DirectoryCache.RACY_INTERVAL:
+            return os.listdir(path)
+
+        return names
+
+    def memory_footprint(self):
+        size = self._trie.memory_footprint()
+        if self._untracked_trie is not None:
+            size += self._untracked_trie.memory_footprint()
+
+        return size
+
+    def _load(self):
+        """
+            Get the PathTries of the files in the index and of the untracked
+            files, and the earliest time git was asked for either.
+        """
+        try:
+            index_mtime = os.stat(self.index_path).st_mtime
+        except OSError:
+            index_mtime = None
+
+        with self._lock:
+            if self._untracked_trie is None:
+                self._untracked_listed_at = time.time()
+                untracked = run_git(['ls-files', '-z', '--others', '--exclude-standard'], self.root)
+                self._untracked_trie = PathTrie((untracked or '').split('\0'))
+
+            if index_mtime != self._index_mtime:
+                listed_at = time.time()
+                tracked = run_git(['ls-files', '-z'], self.root)
+                self._trie = PathTrie((tracked or '').split('\0'))
+                self._index_mtime = index_mtime
+                self._listed_at = listed_at
+
+            return (
+                self._trie,
+                self._untracked_trie,
+                min(self._listed_at, self._untracked_listed_at)
+            )
+
+
+def run_git(arguments, cwd):
+    """
+        Run git with arguments in cwd, returning its output, or None if git
+        could not be run or failed.
+    """
+    startupinfo = None
+    if os.name == 'nt':
+        # Keep git from opening a console window.
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+    try:
+        process = subprocess.Popen(
+            ['git'] + arguments,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            startupinfo=startupinfo
+        )
+        output = process.communicate()[0]
+    except OSError:
+        return None
+
+    if process.returncode != 0:
+        return None
+
+    try:
+        return output.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+_git_indexes = {}
+_git_indexes_lock = threading.Lock()
+
+
+def open_git_indexes(folders):
+    """
+        Make sure directory_cache has a GitIndexSource for the work tree of
+        each of the project folders that is in one.
+    """
+    with _git_indexes_lock:
+        for folder in folders:
+            if folder in _git_indexes:
+                continue
+
+            output = run_git(['rev-parse', '--show-toplevel', '--git-dir'], folder)
+            lines = output and output.splitlines()
+            if not lines or len(lines) < 2:
+                _git_indexes[folder] = None
+                continue
+
+            root = os.path.normpath(lines[0])
+            git_dir = os.path.join(folder, lines[1])
+
+            if root in _git_indexes:
+                _git_indexes[folder] = _git_indexes[root]
+                continue
+
+            source = GitIndexSource(root, git_dir)
+            _git_indexes[folder] = _git_indexes[root] = source
+            directory_cache.add_source(source)
+            resolution_stats.add_memory_reporter('git index of ' + root, source.memory_footprint)
+
+
+def cached_literal_lookup(path, cache, seen, case_sensitive=False):
+    """
+        Find a path without wildcards by looking its name up in the cached
+        listing of its parent, which costs at most one stat of the parent.
+
+        Return a list of the matching paths, or None if the parent does not
+        exist in the case given, in which case the path has to be globbed
+        case insensitively.
+    """
+    parent, name = os.path.split(path)
+    if not name:
+        return None
+
+    listing = cache.listing(parent, seen)
+    if listing is None:
+        return [] if case_sensitive else None
+
+    names = listing.folded.get(name.lower(), [])
+    if case_sensitive:
+        names = [match for match in names if match == name]
+
+    return [os.path.join(parent, match) for match in names]
+
+
+class GlobNode(object):
+    """
+        A path component in the tree of patterns walked together by
+        iter_insensitive_globs, with the indexes of the patterns ending at it,
+        the indexes of all the patterns passing through it, and its child
+        components in the order they were added.
+    """
+
+    __slots__ = ('children', 'components', 'patterns', 'indexes')
+
+    def __init__(self):
+        self.children = {}
+        self.components = []
+        self.patterns = []
+        self.indexes = set()
+
+    def child(self, component):
+        node = self.children.get(component)
+        if node is None:
+            node = self.children[component] = GlobNode()
+            self.components.append(component)
+
+        return node
+
+
+def iter_insensitive_globs(patterns, cache, seen, cancelled=None, roots=None,
+                           case_sensitive=False, deadline=None, finished=None,
+                           exclude=None, report_done=False):
+    """
+        Case insensitive glob of several patterns at once.  Instead of
+        matching every ancestor of each pattern with glob.glob, the directory
+        listings in cache are walked, with literal path components looked up
+        by their lower-cased form and components containing wildcards
+        matched with fnmatch.  The patterns are walked together, so every
+        directory that more than one of them passes through is listed and
+        matched only once.
+
+        roots, if given, holds the root of each pattern: an existing
+        directory the pattern starts with, where its walk starts and whose
+        case is taken as it is.  If case_sensitive is set, names are matched
+        exactly as they are.
+
+        Yields (index, path) for each path matching the pattern at index as
+        soon as it is found.  The matches of each pattern come in the order
+        glob.glob would return them.  If report_done is set,
+        (index, None) is also yielded as soon as the walk is done with the
+        pattern at index, so its matches can be used before the other
+        patterns are done.
+
+        The walk stops if the cancelled event is set or time.time() passes
+        deadline, without reporting the patterns it had not done.  Patterns
+        whose index the caller adds to the finished set while iterating are
+        not walked any further.  Names matched by wildcards are skipped if
+        the ExcludePatterns exclude leaves them out, so excluded folders are
+        never listed.
+    """
+    trees = {}
+    starts = []
+
+    for index, pattern in enumerate(patterns):
+        root = roots and roots[index]
+        if root and pattern.startswith(root.rstrip(os.sep) + os.sep):
+            start = root.rstrip(os.sep)
+            components = pattern[len(start):].split(os.sep)
+        else:
+            drive, pattern = os.path.splitdrive(pattern)
+            components = pattern.split(os.sep)
+
+            if components[0]:
+                continue
+
+            start = drive + os.sep
+
+        node = trees.get(start)
+        if node is None:
+            node = trees[start] = GlobNode()
+            starts.append(start)
+
+        node.indexes.add(index)
+        for component in components[1:]:
+            if component:
+                node = node.child(component)
+                node.indexes.add(index)
+
+        node.patterns.append(index)
+
+    def stopped():
+        if cancelled is not None and cancelled.is_set():
+            return True
+
+        return deadline is not None and time.time() > deadline
+
+    if finished is None:
+        finished = set()
+
+    # The starts are the components of a node above the trees, which the
+    # walk takes as they are.
+    top = GlobNode()
+    top.components = starts
+    top.children = trees
+
+    # Patterns that do not start with a separator are not walked at all.
+    undone = set()
+    for tree in trees.values():
+        undone.update(tree.indexes)
+
+    if report_done:
+        for index in range(len(patterns)):
+            if index not in undone:
+                yield index, None
+
+    # Depth first, which for each pattern visits its matches in the order
+    # glob would list them level by level.  With an I/O pool, the
+    # directories under each directory walked into are read ahead in
+    # parallel.
+    stack = [_GlobFrame('', top, None)]
+    if cache.parallel:
+        stack[-1].read_ahead(cache, seen, finished, case_sensitive, exclude)
+    check_done = False
+    while stack:
+        # Once a frame has taken its last name for a component, and the
+        # directory the name leads to is on the stack, the patterns only the
+        # component's names could match are done.
+        if report_done and check_done:
+            for index in _done_patterns(stack, undone):
+                undone.discard(index)
+                yield index, None
+            check_done = False
+
+        frame = stack[-1]
+        name = frame.next_name(case_sensitive, exclude)
+        if name is None:
+            stack.pop()
+            check_done = True
+            continue
+
+        check_done = not frame.names
+
+        node = frame.node.children[frame.node.components[frame.position]]
+        path = os.path.join(frame.path, name)
+
+        for index in node.patterns:
+            if index not in finished:
+                yield index, path
+
+        if not node.components or finished.issuperset(node.indexes):
+            continue
+
+        if stopped():
+            return
+
+        listing = cache.listing(path, seen)
+        if listing is not None:
+            stack.append(_GlobFrame(path, node, listing))
+            if cache.parallel:
+                stack[-1].read_ahead(cache, seen, finished, case_sensitive, exclude)
+
+    if report_done:
+        for index in sorted(undone):
+            yield index, None
+
+
+class _GlobFrame(object):
+    """
+        A directory being walked by iter_insensitive_globs: its node, its
+        listing, the position in the node's components of the component
+        being matched, and the names matching it that are still to be
+        walked.  The frame of the node above the trees has no listing, and
+        its components are taken as they are.
+    """
+
+    __slots__ = ('path', 'node', 'listing', 'position', 'names', 'matched')
+
+    def __init__(self, path, node, listing):
+        self.path = path
+        self.node = node
+        self.listing = listing
+        self.position = -1
+        self.names = []
+        self.matched = None
+
+    def read_ahead(self, cache, seen, finished, case_sensitive, exclude):
+        """
+            Match every component at once, and read the directories the
+            names lead to in parallel, so the walk finds them in seen.
+            Directories only finished patterns would walk into are left
+            alone.
+        """
+        self.matched = []
+        paths = []
+        for component in self.node.components:
+            child = self.node.children[component]
+            if self.listing is None:
+                names = [component]
+            else:
+                names = list(_match_child(self.listing, component, child, case_sensitive, exclude))
+
+            self.matched.append(names)
+            if child.components and not finished.issuperset(child.indexes):
+                paths += [os.path.join(self.path, name) for name in names]
+
+        cache.listings(paths, seen)
+
+    def next_name(self, case_sensitive, exclude):
+        """
+            Take the next name to walk, or None if there is none left.
+        """
+        while not self.names:
+            if self.position + 1 >= len(self.node.components):
+                return None
+
+            self.position += 1
+            component = self.node.components[self.position]
+            if self.matched is not None:
+                names = self.matched[self.position]
+            elif self.listing is None:
+                names = [component]
+            else:
+                child = self.node.children[component]
+                names = _match_child(self.listing, component, child, case_sensitive, exclude)
+
+            self.names = list(names)
+            self.names.reverse()
+
+        return self.names.pop()
+
+    def live_indexes(self):
+        """
+            Get the indexes of the patterns the names left to walk can match.
+        """
+        components = self.node.components
+        if self.names:
+            components = components[self.position:]
+        else:
+            components = components[self.position + 1:]
+
+        live = set()
+        for component in components:
+            live.update(self.node.children[component].indexes)
+
+        return live
+
+
+def _done_patterns(stack, undone):
+    """
+        Get the indexes in undone of the patterns no frame of the walk's
+        stack can match anything more of, in order.
+    """
+    live = set()
+    for frame in stack:
+        live.update(frame.live_indexes())
+
+    return sorted(undone - live)
+
+
+def _match_child(listing, component, child, case_sensitive, exclude):
+    """
+        Iterate over the names in listing matching component, leaving out
+        those that exclude does.  Only names matched by wildcards are left
+        out; a name spelled out in a pattern is always followed.  Names the
+        walk descends into are matched against the folder patterns, and the
+        rest against the file patterns.
+    """
+    names = _match_component(listing, component, case_sensitive)
+    if exclude is None or not glob.has_magic(component):
+        return names
+
+    folder = bool(child.components)
+    return (name for name in names if not exclude.excludes(name, folder))
+
+
+def _match_component(listing, component, case_sensitive):
+    """
+        Iterate over the names in listing matching one component of a glob
+        pattern.  Hidden names only match components starting with a dot.
+    """
+    if not glob.has_magic(component):
+        names = listing.folded.get(component.lower(), [])
+        if case_sensitive:
+            names = [name for name in names if name == component]
+
+        return names
+
+    include_hidden = component.startswith('.')
+
+    if case_sensitive:
+        return (
+            name for name in listing.names
+            if fnmatch.fnmatchcase(name, component)
+            and (include_hidden or not name.startswith('.'))
+        )
+
+    folded_component = component.lower()
+    return (
+        name for name in listing.names
+        if fnmatch.fnmatchcase(name.lower(), folded_component)
+        and (include_hidden or not name.startswith('.'))
+    )
+
+
+class ExcludePatterns(object):
+    """
+        Names of folders and of files to leave out of wildcard matches, given
+        as fnmatch patterns like Sublime Text's folder_exclude_patterns and
+        file_exclude_patterns.
+    """
+
+    def __init__(self, folder_patterns=(), file_patterns=()):
+        self.folders = self._compile(folder_patterns)
+        self.files = self._compile(file_patterns)
+
+    def _compile(self, patterns):
+        if not patterns:
+            return None
+
+        return re.compile('|'.join([
+            '(?:%s)' % fnmatch.translate(pattern) for pattern in patterns
+        ]))
+
+    def excludes(self, name, folder):
+        patterns = folder and self.folders or self.files
+        return patterns is not None and patterns.match(name) is not None
+
+
+class CompiledConfiguration(object):
+    """
+        The enabled configurations from a settings file, in the order they
+        are enabled, with their search paths resolved and indexed.
+    """
+
+    def __init__(self, settings, enabled_configurations):
+        self.configs = []
+
+        for config_key in enabled_configurations:
+            config_details = settings.get(config_key)
+            if config_details:
+                self.configs.append(CompiledConfig(config_key, config_details))
+
+        # Identifies the configurations across sessions.
+        self.digest = self.get_digest(settings, enabled_configurations)
+
+        self._path_index = self._build_path_index()
+
+    @staticmethod
+    def get_digest(settings, enabled_configurations):
+        """
+            Get the digest a CompiledConfiguration of the enabled
+            configurations in settings would have, without compiling them.
+        """
+        configurations = []
+        for config_key in enabled_configurations:
+            config_details = settings.get(config_key)
+            if config_details:
+                configurations.append([config_key, config_details])
+
+        return hashlib.md5(
+            json.dumps(configurations, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def match(self, file_path):
+        """
+        Find the first configuration whose root directory is contained in
+        file_path.
+
+        Return a tuple of the CompiledConfig and the full path to its app dir,
+        or (None, None) if no configuration matches.
+        """
+        found = self._path_index.search(file_path)
+        if not found:
+            return None, None
+
+        (config_index, path_index), matched_path, module = found
+        config = self.configs[config_index]
+        path = config.paths[path_index]
+        app_path = config.app_dir
+
+        if module is not None:
+            app_path = app_path.replace('{%}', module)
+            path = path.replace('{%}', module)
+
+        path_before_app_path = matched_path.rstrip(os.sep).replace(path, '')
+
+        return config, path_before_app_path + app_path
+
+    def _build_path_index(self):
+        path_index = PathComponentIndex()
+        for config_index, config in enumerate(self.configs):
+            for path_index_in_config, path in enumerate(config.paths):
+                path_index.add(path, (config_index, path_index_in_config))
+        return path_index
+
+
+class PathComponentIndex(object):
+    """
+        Trie of search paths keyed on their path components, where a {%}
+        component is a wildcard edge matching any single directory name.
+
+        search() finds the search path with the lowest rank that occurs as a
+        sequence of whole directories in a file path, by walking the trie from
+        each directory of the file path instead of testing every search path.
+    """
+
+    def __init__(self):
+        self.root = PathComponentNode()
+
+    def add(self, path, rank):
+        node = self.root
+        for component in path.split(os.sep):
+            if component == '{%}':
+                if node.wildcard is None:
+                    node.wildcard = PathComponentNode()
+                node = node.wildcard
+            else:
+                node = node.children.setdefault(component, PathComponentNode())
+
+        if node.rank is None or rank < node.rank:
+            node.rank = rank
+
+    def search(self, file_path):
+        """
+        Return a tuple of the rank of the best matching search path, file_path
+        up to and including the matched directories and a trailing separator,
+        and the directory matched by {%} (or None), or None if no search path
+        occurs in file_path.
+
+        A search path must be preceded and followed by a separator, so it can
+        neither start at the beginning of file_path nor include the file name.
+        Among matches of the same search path the leftmost one wins.
+        """
+        components = file_path.split(os.sep)
+        best = None
+
+        for start in range(1, len(components) - 1):
+            states = [(self.root, None)]
+
+            for end in range(start, len(components) - 1):
+                component = components[end]
+                next_states = []
+
+                for node, module in states:
+                    child = node.children.get(component)
+                    if child is not None:
+                        next_states.append((child, module))
+                    if node.wildcard is not None and component:
+                        next_states.append((node.wildcard, component))
+
+                for node, module in next_states:
+                    if node.rank is not None and (best is None or node.rank < best[0]):
+                        best = (
+                            node.rank,
+                            os.sep.join(components[:end + 1]) + os.sep,
+                            module
+                        )
+
+                states = next_states
+                if not states:
+                    break
+
+        return best
+
+
+class PathComponentNode(object):
+
+    __slots__ = ('children', 'wildcard', 'rank')
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None
+        self.rank = None
+
+
+class CompiledConfig(object):
+
+    def __init__(self, name, details):
+        self.name = name
+        self.details = details
+        self.app_dir = details['app_dir'].replace('/', os.sep)
+        self.case_sensitive = bool(details.get('case_sensitive', False))
+        self._exclude_patterns = {}
+
+        self.paths = self._get_possible_paths()
+
+        # Sort types backwards, so that *, if present, is last.
+        self.file_types = [
+            (file_type, file_type_details, file_type_details['path'].replace('/', os.sep))
+            for file_type, file_type_details in sorted(
+                details['file_types'].items(),
+                key=lambda item: item[0],
+                reverse=True
+            )
+        ]
+
+        # The rel_patterns of each file type, compiled in the order they
+        # are configured.
+        self.glob_plans = {}
+        for file_type, file_type_details in details['file_types'].items():
+            self.glob_plans[file_type] = [
+                GlobPlan(
+                    target_type,
+                    pattern,
+                    details['file_types'].get(target_type, {})
+                )
+                for target_type, pattern
+                in file_type_details.get('rel_patterns', {}).items()
+            ]
+
+    def get_exclude_patterns(self, folder_patterns=(), file_patterns=()):
+        """
+            Get the ExcludePatterns leaving out the given folders and files,
+            along with any names in the configuration's "exclude" list.
+        """
+        key = (tuple(folder_patterns), tuple(file_patterns))
+        exclude_patterns = self._exclude_patterns.get(key)
+
+        if exclude_patterns is None:
+            configured = list(self.details.get('exclude', []))
+            exclude_patterns = self._exclude_patterns[key] = ExcludePatterns(
+                list(folder_patterns) + configured,
+                list(file_patterns) + configured
+            )
+
+        return exclude_patterns
+
+    def _get_possible_paths(self):
+        """
+        Get the paths which identify a file as belonging to this
+        configuration.
+
+        They will include the app_dir, as well as any other possible paths
+        for the configuration which are implied by directory traversals in
+        type paths.
+        """
+        paths = [self.app_dir]
+
+        for file_type, file_type_details in self.details['file_types'].items():
+            type_path = file_type_details['path']
+            if '..' in type_path:
+                path_outside_of_app_path = os.path.normpath(
+                    self.app_dir + os.sep + type_path.replace('/', os.sep)
+                )
+
+                paths.append(path_outside_of_app_path)
+
+        return paths
+
+
+class GlobPlan(object):
+    """
+        A rel_pattern compiled for one target file type, so that resolving it
+        is only a matter of joining strings.
+
+        The template is split into literal text and the variables it
+        references, and the target type path is split on its {%} wildcards.
+        Patterns that start with the app path are anchored there, so their
+        walk does not list the ancestors of the app dir.
+    """
+
+    __slots__ = (
+        'file_type',
+        'pieces',
+        'type_path_parts',
+        'prefix',
+        'suffix',
+        'anchored'
+    )
+
+    ANCHORS = ('app_path', 'full_type_path')
+
+    def __init__(self, file_type, pattern, target_details):
+        self.file_type = file_type
+        self.pieces = self._parse_template(pattern.replace('/', os.sep))
+        self.type_path_parts = tuple(
+            target_details.get('path', '').replace('/', os.sep).split('{%}')
+        )
+        self.prefix = target_details.get('prefix', '')
+        self.suffix = target_details.get('suffix', '')
+        self.anchored = bool(self.pieces) and self.pieces[0][1] in self.ANCHORS
+
+    def _parse_template(self, template):
+        """
+            Split a string.Template into a tuple of (literal, variable) pairs,
+            where variable is None for literal text.  Placeholders that are
+            not template variables are kept as literal text, the same as
+            safe_substitute would leave them.
+        """
+        pieces = []
+        position = 0
+
+        for match in Template.pattern.finditer(template):
+            literal = template[position:match.start()]
+            variable = match.group('named') or match.group('braced')
+
+            if match.group('escaped') is not None:
+                literal += '$'
+            elif variable is None:
+                literal += match.group(0)
+
+            if literal:
+                pieces.append((literal, None))
+            if variable is not None:
+                pieces.append((match.group(0), variable))
+
+            position = match.end()
+
+        if position < len(template):
+            pieces.append((template[position:], None))
+
+        return tuple(pieces)
+
+    def type_path(self, wildcard_values):
+        """
+            Get the target type path with its {%} wildcards replaced by the
+            values from the current file, in order.
+        """
+        parts = self.type_path_parts
+        if len(parts) == 1:
+            return parts[0]
+
+        values = list(wildcard_values[:len(parts) - 1])
+        values += ['{%}'] * (len(parts) - 1 - len(values))
+
+        path = [parts[0]]
+        for value, part in zip(values, parts[1:]):
+            path.append(value)
+            path.append(part)
+
+        return ''.join(path)
+
+    def substitute(self, variables):
+        """
+            Get the glob pattern for the given template variables, with the
+            target type's prefix and suffix added to its file name.
+        """
+        pattern = ''.join([
+            variables.get(variable, text) if variable else text
+            for text, variable in self.pieces
+        ])
+
+        if not (self.prefix or self.suffix):
+            return pattern
+
+        # The prefix goes before the last path component and the suffix
+        # before its last extension, if it has one.
+        extension = pattern.rfind('.')
+        if extension == -1 or extension == len(pattern) - 1:
+            return pattern
+
+        name = max(1, pattern.rfind(os.sep, 0, extension) + 1)
+        if name >= extension:
+            return pattern
+
+        return ''.join([
+            pattern[:name],
+            self.prefix,
+            pattern[name:extension],
+            self.suffix,
+            pattern[extension:]
+        ])
+
+
+class RelatedFilesCache(object):
+    """
+        Bounded cache of resolved related files, keyed by the path of the
+        current file and the digest of the compiled configuration they were
+        resolved with.  The least recently used entries are evicted once
+        max_entries is exceeded.
+
+        Each entry remembers the directories that were listed to resolve it,
+        so that it can be dropped when one of them changes.
+
+        Once load() has been called with a path, the entries are also saved
+        there, and read back from it by the next session.  They are saved on
+        a background thread save_delay seconds after an entry is set, so that
+        setting entries in quick succession writes them once, or when save()
+        is called.  Entries read back are not tied to any directories, so
+        they may be stale.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, max_entries=200, save_delay=5):
+        self.max_entries = max_entries
+        self.save_delay = save_delay
+        self.path = None
+        self._entries = {}
+        self._keys_by_directory = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self._tick = 0
+
+    def load(self, path):
+        """
+            Read the entries saved at path, and save entries there from now
+            on.  Does nothing if already loaded from path.
+        """
+        if path == self.path:
+            return
+
+        try:
+            with open(path) as saved_file:
+                saved = json.load(saved_file)
+        except (IOError, OSError, ValueError):
+            saved = None
+
+        with self._lock:
+            self.path = path
+
+        if not saved or saved.get('version') != self.FORMAT_VERSION:
+            return
+
+        with self._lock:
+            for current_file, digest, related_files in saved['entries']:
+                key = (current_file, digest)
+                if key not in self._entries:
+                    self._tick += 1
+                    self._entries[key] = [self._tick, related_files, []]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            self._tick += 1
+            entry[0] = self._tick
+            return list(entry[1])
+
+    def set(self, key, related_files, directories=()):
+        with self._lock:
+            self._remove(key)
+
+            self._tick += 1
+            self._entries[key] = [self._tick, list(related_files), list(directories)]
+            for directory in directories:
+                self._keys_by_directory.setdefault(directory, set()).add(key)
+
+            if len(self._entries) > self.max_entries:
+                by_age = sorted(self._entries.items(), key=lambda item: item[1][0])
+                for old_key, entry in by_age[:len(by_age) // 4 or 1]:
+                    self._remove(old_key)
+
+            if self.path is not None and self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self.save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def save(self):
+        """
+            Save the entries to the path they were loaded from, if any were
+            set since they were last saved.
+        """
+        with self._lock:
+            if self._save_timer is None:
+                return
+
+            self._save_timer.cancel()
+            self._save_timer = None
+            path = self.path
+            entries = [
+                [key[0], key[1], entry[1]]
+                for key, entry in sorted(self._entries.items(), key=lambda item: item[1][0])
+            ]
+
+        with self._save_lock:
+            temporary_path = path + '.tmp'
+            try:
+                with open(temporary_path, 'w') as saved_file:
+                    json.dump({'version': self.FORMAT_VERSION, 'entries': entries}, saved_file)
+
+                if os.name == 'nt' and os.path.exists(path):
+                    os.remove(path)
+                os.rename(temporary_path, path)
+            except (IOError, OSError):
+                pass
+
+    def invalidate_directory(self, directory):
+        with self._lock:
+            for key in list(self._keys_by_directory.get(directory, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_directory.clear()
+
+    def _remove(self, key):
+        """
+        Remove the entry for key.  Called with the lock held.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        for directory in entry[2]:
+            keys = self._keys_by_directory.get(directory)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_directory[directory]
+
+
+related_files_cache = RelatedFilesCache()
+
+
+_directory_watcher = None
+_directory_watcher_lock = threading.Lock()
+
+
+def start_directory_watcher():
+    """
+        Start watching the directories directory_cache lists, so that cached
+        listings and related files are dropped as soon as they go stale.
+    """
+    global _directory_watcher
+
+    with _directory_watcher_lock:
+        if _directory_watcher is not None:
+            return
+
+        _directory_watcher = DirectoryWatcher()
+        _directory_watcher.add_listener(invalidate_directory)
+        directory_cache.watcher = _directory_watcher
+
+
+def invalidate_directory(path):
+    """
+        Drop everything cached about the listing of the directory at path, or
+        about every directory if path is None.
+    """
+    if path is None:
+        directory_cache.clear()
+        related_files_cache.clear()
+        path_normalizer.clear()
+    else:
+        directory_cache.invalidate(path)
+        related_files_cache.invalidate_directory(path)
+        path_normalizer.invalidate(path)
+
+
+class ResolutionStats(object):
+    """
+        Timings and operation counts of the most recent resolutions.
+
+        Each resolution is recorded as a sample holding the seconds spent in
+        each phase and its counters.  The last max_samples samples are kept
+        for reporting, and each one is also appended to log_file as a line of
+        JSON if log_file is set.
+    """
+
+    PHASES = ['configuration_match', 'type_detection', 'template_vars', 'globbing', 'total']
+
+    # Upper bounds, in milliseconds, of the buckets of the latency histogram.
+    HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
+    def __init__(self, max_samples=1000):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.counters = {}
+        self.log_file = None
+        self.memory_reporters = []
+        self._lock = threading.Lock()
+
+    def add_memory_reporter(self, name, memory_footprint):
+        """
+        Report the number of bytes returned by memory_footprint() under name.
+        """
+        with self._lock:
+            self.memory_reporters.append((name, memory_footprint))
+
+    def record(self, file_path, timings, counters):
+        timings = dict(timings)
+        timings['total'] = sum(timings.values())
+
+        sample = {
+            'time': time.time(),
+            'file': file_path,
+            'timings': timings,
+            'counters': dict(counters)
+        }
+
+        with self._lock:
+            self.samples.append(sample)
+            log_file = self.log_file
+
+        if log_file:
+            try:
+                log = open(log_file, 'a')
+                try:
+                    log.write(json.dumps(sample, sort_keys=True) + '\n')
+                finally:
+                    log.close()
+            except (IOError, OSError):
+                pass
+
+    def count(self, counter, amount=1):
+        """
+        Count something that happens outside of a single resolution, such as a
+        lookup in related_files_cache.
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self.samples.clear()
+            self.counters.clear()
+
+    def format(self):
+        """
+        Format the recorded samples as a plain text report.
+        """
+        with self._lock:
+            samples = list(self.samples)
+            counters = dict(self.counters)
+
+        lines = [
+            'GotoRelatedFile performance stats',
+            '',
+            'Resolutions: %d (the last %d are kept)' % (len(samples), self.samples.maxlen),
+            ''
+        ]
+
+        if not samples:
+            return '\n'.join(lines + ['No resolutions recorded yet.', ''] + self._format_memory())
+
+        lines.append('%-22s %10s %10s %10s %10s' % ('phase (ms)', 'p50', 'p95', 'p99', 'max'))
+        for phase in self.PHASES:
+            values = sorted(
+                sample['timings'][phase] * 1000
+                for sample in samples
+                if phase in sample['timings']
+            )
+            if values:
+                lines.append('%-22s %10.3f %10.3f %10.3f %10.3f' % (
+                    phase,
+                    self._percentile(values, 0.5),
+                    self._percentile(values, 0.95),
+                    self._percentile(values, 0.99),
+                    values[-1]
+                ))
+
+        lines += ['', 'Total latency histogram:']
+        buckets = [0] * (len(self.HISTOGRAM_BUCKETS) + 1)
+        for sample in samples:
+            total = sample['timings']['total'] * 1000
+            bucket = 0
+            while bucket < len(self.HISTOGRAM_BUCKETS) and total >= self.HISTOGRAM_BUCKETS[bucket]:
+                bucket += 1
+            buckets[bucket] += 1
+
+        for bucket, sample_count in enumerate(buckets):
+            if bucket < len(self.HISTOGRAM_BUCKETS):
+                label = '< %d ms' % self.HISTOGRAM_BUCKETS[bucket]
+            else:
+                label = '>= %d ms' % self.HISTOGRAM_BUCKETS[-1]
+            bar = '#' * int(round(40.0 * sample_count / len(samples)))
+            lines.append(('  %-12s %6d %s' % (label, sample_count, bar)).rstrip())
+
+        totals = {}
+        for sample in samples:
+            for counter, amount in sample['counters'].items():
+                totals[counter] = totals.get(counter, 0) + amount
+
+        lines += ['', 'Operations per resolution (mean):']
+        for counter in ('realpath', 'stat', 'listdir', 'isfile'):
+            lines.append('  %-12s %8.2f' % (counter, float(totals.get(counter, 0)) / len(samples)))
+
+        lines += ['', 'Cache hit rates:']
+        lines.append('  %s' % self._hit_rate(
+            'directory listings',
+            totals.get('listing_cache_hits', 0),
+            totals.get('listing_cache_misses', 0)
+        ))
+        lines.append('  %s' % self._hit_rate(
+            'missing directories',
+            totals.get('missing_cache_hits', 0),
+            totals.get('missing_cache_misses', 0)
+        ))
+        lines.append('  %s' % self._hit_rate(
+            'related files',
+            counters.get('related_files_cache_hits', 0),
+            counters.get('related_files_cache_misses', 0)
+        ))
+
+        return '\n'.join(lines + [''] + self._format_memory())
+
+    def _format_memory(self):
+        with self._lock:
+            memory_reporters = list(self.memory_reporters)
+
+        if not memory_reporters:
+            return []
+
+        lines = ['Memory (approximate):']
+        for name, memory_footprint in memory_reporters:
+            lines.append('  %-40s %8.1f MB' % (name, memory_footprint() / 1048576.0))
+
+        return lines + ['']
+
+    def _percentile(self, sorted_values, fraction):
+        return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+    def _hit_rate(self, name, hits, misses):
+        lookups = hits + misses
+        if not lookups:
+            return '%-20s n/a' % name
+        return '%-20s %5.1f%% (%d of %d)' % (name, 100.0 * hits / lookups, hits, lookups)
+
+
+resolution_stats = ResolutionStats()
+resolution_stats.add_memory_reporter('directory listings', directory_cache.memory_footprint)
+
+
+class ResolutionContext(object):
+    """
+        Everything derived from the current file that its rel_patterns are
+        resolved against: its file type, the full path to its type path, the
+        values of any {%} wildcards in the type path, and the template
+        variables.  Computed once per current file and never modified.
+    """
+
+    __slots__ = (
+        'file_type',
+        'file_type_details',
+        'app_path',
+        'type_path',
+        'wildcard_values',
+        'template_vars'
+    )
+
+    def __init__(self, file_type, file_type_details, app_path, type_path,
+                 wildcard_values, template_vars):
+        set_slot = super(ResolutionContext, self).__setattr__
+        set_slot('file_type', file_type)
+        set_slot('file_type_details', file_type_details)
+        set_slot('app_path', app_path)
+        set_slot('type_path', type_path)
+        set_slot('wildcard_values', tuple(wildcard_values))
+        set_slot('template_vars', template_vars)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ResolutionContext is immutable')
+
+
+class RelatedFileResolver(object):
+    """
+        Resolves the related files of one file, given the configuration that
+        matched it and the full path to that configuration's app dir.
+
+        A resolution stops after timeout seconds, or once it has found
+        max_results files, or max_results_per_pattern files for a single
+        rel_pattern, and marks what it leaves out with an entry whose path
+        is None.  Names matched by wildcards are left out if the
+        ExcludePatterns exclude, by default those of the configuration,
+        leaves them out.  The resolution is recorded in resolution_stats
+        unless record_stats is unset.
+    """
+
+    def __init__(self, config, app_path, current_file, cache=None, timeout=None,
+                 max_results=None, max_results_per_pattern=None, exclude=None,
+                 record_stats=True):
+        self.config = config
+        self.configuration = config.details
+        self.app_path = app_path
+        self.current_file = current_file
+        self.cache = cache or directory_cache
+        self.timeout = timeout
+        self.max_results = max_results
+        self.max_results_per_pattern = max_results_per_pattern
+        self.exclude = exclude or config.get_exclude_patterns()
+        self.record_stats = record_stats
+        self.truncated = False
+        self.seen_directories = {}
+        self.timings = {}
+        self.counters = {}
+        self._context = None
+
+    def get_context(self):
+        """
+            Get the ResolutionContext of the current file, or None if it is
+            not of any configured type.
+        """
+        if self._context is None:
+            self._context = self._get_resolution_context() or False
+
+        return self._context or None
+
+    def get_related_files(self):
+        """
+            Return list of lists with element 0 the file description
+            and element 1 the path.
+        """
+        related_files = []
+        for files in self.iter_related_files():
+            related_files += files
+
+        return related_files
+
+    def _get_resolution_context(self):
+        """
+            Detect the type of the current file and derive everything the
+            rel_patterns are resolved against.  Return a ResolutionContext, or
+            None if the current file is not of any configured type.
+        """
+        start = time.time()
+
+        for file_type, details, path_pattern in self.config.file_types:
+            type_path, wildcard_values = self._get_file_type_path(
+                path_pattern,
+                self.current_file
+            )
+
+            if not type_path:
+                continue
+
+            # Resolved in full, like the directories of the related files
+            # found, so that a related file is of the type it was found as.
+            type_path = path_normalizer.normalize_directory(
+                os.path.join(
+                    self.app_path,
+                    type_path
+                ).replace('/', os.sep),
+                self.counters
+            )
+
+            if self.current_file.startswith(type_path):
+                detected = time.time()
+                template_vars = self._get_template_var_values(details, type_path)
+                self.timings['type_detection'] = detected - start
+                self.timings['template_vars'] = time.time() - detected
+
+                return ResolutionContext(
+                    file_type,
+                    details,
+                    self.app_path,
+                    type_path,
+                    wildcard_values,
+                    template_vars
+                )
+
+        self.timings['type_detection'] = time.time() - start
+        return None
+
+    def _realpath(self, path):
+        return path_normalizer.normalize(path, self.counters)
+
+    def _get_file_type_path(self, path_pattern, file_path):
+        """
+        Get the file type path given the path pattern and the path of
+        a file of that type.  Paths with a {%} wildcard will be replaced
+        with the actual value used in the file path.
+
+        Return a tuple of the path and the values of the {%} wildcards, or
+        (None, ()) if the wildcards could not be matched.
+        """
+        pattern = path_normalizer.normalize_directory(
+            self.app_path + os.sep + path_pattern,
+            self.counters
+        )
+
+        if '{%}' not in pattern:
+            return pattern, ()
+
+        pattern = re.escape(pattern) \
+            .replace(re.escape('{%}'), '([^' + re.escape(os.sep) + ']+)')
+
+        match = re.search(
+            pattern,
+            file_path
+        )
+        if match:
+            return match.group(0), match.groups()
+
+        return None, ()
+
+    def _get_template_var_values(self, file_type_details, file_type_path):
+        """
+            Get a dictionary mapping the supported template variables and their
+            values for the active file, given the details of its file type and
+            the full path to its type path.
+        """
+        current_suffix = file_type_details.get('suffix', '')
+        current_prefix = file_type_details.get('prefix', '')
+
+        current_file_no_ext = os.path.splitext(self.current_file)[0]
+        current_file_no_suffix = re.sub('%s$' % re.escape(current_suffix), '', current_file_no_ext)
+        current_file_no_fixes = re.sub(
+            '%s([^%s]+)$' % (re.escape(current_prefix), re.escape(os.sep)),
+            '\g<1>',
+            current_file_no_suffix
+        )
+        current_file = current_file_no_fixes
+
+        file_from_type_path = current_file.replace(file_type_path, '', 1).strip(os.sep)
+        file_from_app_path = current_file.replace(self.app_path, '', 1).strip(os.sep)
+        dir_from_type_path = os.path.dirname(file_from_type_path).strip(os.sep)
+
+        return {
+            'base_filename': os.path.basename(current_file),
+            'file_from_type_path': file_from_type_path,
+            'file_from_app_path': file_from_app_path,
+            'dir_from_type_path': dir_from_type_path
+        }
+
+    def _is_creatable_file(self, glob_pattern):
+        return '*' not in glob_pattern
+
+    def iter_related_files(self, cancelled=None):
+        """
+            Resolve the rel_patterns of the current file, yielding the list
+            of related files found for each in turn, as soon as it and the
+            ones before it are done.  The patterns are globbed together in
+            one walk.  Stops early if the cancelled event is set.
+        """
+        context = self.get_context()
+
+        if context is None:
+            return
+
+        if cancelled is not None and cancelled.is_set():
+            return
+
+        start = time.time()
+        deadline = self.timeout and start + self.timeout or None
+        self.truncated = False
+
+        # Directories whose listings have been read during this resolution.
+        self.seen_directories = self.cache.begin_resolution()
+
+        plans = self.config.glob_plans.get(context.file_type, [])
+        glob_patterns = self._get_glob_patterns(context, plans)
+        all_files = [[] for glob_pattern in glob_patterns]
+        matched = [False] * len(glob_patterns)
+        capped = set()
+
+        # Whether the truncation of the whole resolution should be marked is
+        # only known once the walk is over, so the last pattern's files wait
+        # for it.
+        done = set()
+        next_index = 0
+        for index in self._find_files(plans, glob_patterns, all_files, matched,
+                                      capped, cancelled, deadline):
+            done.add(index)
+            while next_index in done and next_index < len(plans) - 1:
+                if cancelled is not None and cancelled.is_set():
+                    return
+
+                yield self._get_pattern_files(
+                    plans[next_index],
+                    glob_patterns[next_index],
+                    all_files[next_index],
+                    matched[next_index],
+                    next_index in capped,
+                    start
+                )
+                next_index += 1
+
+        if cancelled is not None and cancelled.is_set():
+            return
+
+        for index in range(next_index, len(plans)):
+            related_files = self._get_pattern_files(
+                plans[index],
+                glob_patterns[index],
+                all_files[index],
+                matched[index],
+                index in capped,
+                start
+            )
+            if index == len(plans) - 1 and self.truncated and not capped:
+                related_files.append(['More related files not shown (truncated)', None])
+
+            yield related_files
+
+        if self.record_stats:
+            self._record_stats()
+
+    def _get_pattern_files(self, plan, glob_pattern, files, matched, capped, start):
+        """
+            Get the list of related files for the files found for a glob
+            plan: the files to open, the file to create if nothing matched
+            and one can be, and whether some were left out.
+        """
+        file_type = plan.file_type
+        related_files = [
+            ['Open %s (%s)' % (file_type, os.path.basename(match)), match]
+            for match in files
+        ]
+
+        if (not matched and self._is_creatable_file(glob_pattern)):
+            creatable_file_path = glob_pattern
+            related_files.append(
+                [
+                    'Create %s (%s)' % (
+                        file_type,
+                        os.path.basename(creatable_file_path)
+                    ),
+                    creatable_file_path
+                ]
+            )
+
+        if capped:
+            related_files.append(['More %s files not shown (truncated)' % file_type, None])
+
+        self.timings['globbing'] = time.time() - start
+
+        return related_files
+
+    def _get_glob_patterns(self, context, plans):
+        """
+            Substitute the template variables of the current file into each
+            of the glob plans.
+        """
+        variables = dict(context.template_vars)
+        variables['app_path'] = self.app_path
+        variables['suffix'] = ''  # For backward compatability
+
+        glob_patterns = []
+        for plan in plans:
+            target_file_type_path = plan.type_path(context.wildcard_values)
+            variables['type_path'] = target_file_type_path
+            variables['full_type_path'] = self.app_path + os.sep + target_file_type_path
+
+            glob_patterns.append(self._realpath(plan.substitute(variables)))
+
+        return glob_patterns
+
+    def _find_files(self, plans, glob_patterns, all_files, matched, capped,
+                    cancelled, deadline):
+        """
+            Find the files matching each glob pattern, adding them to its
+            list in all_files, and yield the index of each pattern once
+            nothing more can match it.  Patterns without wildcards are looked
+            up in the listing of their parent; the rest, and any whose parent
+            was not found as it is spelled, are globbed together, until the
+            deadline passes or the result limits are reached.
+
+            Also sets whether anything at all matched each pattern in
+            matched, and adds the indexes of the patterns that had more files
+            than they were allowed to capped.
+        """
+        seen_directories = self.seen_directories
+        case_sensitive = self.config.case_sensitive
+        unmatched = []
+        literal_dirs = [self._get_literal_dir(glob_pattern) for glob_pattern in glob_patterns]
+
+        for index, glob_pattern in enumerate(glob_patterns):
+            # Nothing can match under a directory that does not exist.
+            if self.cache.find_missing(literal_dirs[index], seen_directories):
+                yield index
+                continue
+
+            matches = None
+            if not glob.has_magic(glob_pattern):
+                matches = cached_literal_lookup(
+                    glob_pattern,
+                    self.cache,
+                    seen_directories,
+                    case_sensitive
+                )
+
+            if matches is None:
+                unmatched.append(index)
+            else:
+                matched[index] = bool(matches)
+                all_files[index] = [
+                    match for match in matches
+                    if self.cache.is_file(match, seen_directories)
+                ]
+                yield index
+
+        if not unmatched:
+            return
+
+        root = None
+        if [index for index in unmatched if plans[index].anchored]:
+            root = path_normalizer.normalize_directory(self.app_path, self.counters)
+
+        # Positions in unmatched of the patterns that have all the files
+        # they are allowed.
+        finished = set()
+        found = sum([len(files) for files in all_files])
+        done = set()
+
+        for position, match in iter_insensitive_globs(
+                [glob_patterns[index] for index in unmatched],
+                self.cache,
+                seen_directories,
+                cancelled,
+                [plans[index].anchored and root for index in unmatched],
+                case_sensitive,
+                deadline,
+                finished,
+                self.exclude,
+                report_done=True):
+            index = unmatched[position]
+
+            if match is None:
+                # The walk is over for this pattern, so if nothing matched
+                # it, its directory does not exist.
+                if not matched[index]:
+                    self.cache.record_missing(literal_dirs[index], seen_directories)
+                done.add(index)
+                yield index
+                continue
+
+            matched[index] = True
+
+            if not self.cache.is_file(match, seen_directories):
+                continue
+
+            if self.max_results_per_pattern is not None \
+                    and len(all_files[index]) >= self.max_results_per_pattern:
+                capped.add(index)
+                finished.add(position)
+                continue
+
+            if self.max_results is not None and found >= self.max_results:
+                self.truncated = True
+                break
+
+            all_files[index].append(match)
+            found += 1
+
+        if capped or (deadline is not None and time.time() > deadline):
+            self.truncated = True
+
+        for index in unmatched:
+            if index not in done:
+                yield index
+
+    def _get_literal_dir(self, glob_pattern):
+        """
+            Get the directory everything matching glob_pattern is under: the
+            components of the pattern before its first wildcard, or the
+            parent of a pattern without wildcards.
+        """
+        if not glob.has_magic(glob_pattern):
+            return os.path.dirname(glob_pattern)
+
+        components = glob_pattern.split(os.sep)
+        for position, component in enumerate(components):
+            if glob.has_magic(component):
+                return os.sep.join(components[:position]) or os.sep
+
+    def _record_stats(self):
+        counters = dict(self.seen_directories.counters)
+        for counter, amount in self.counters.items():
+            counters[counter] = counters.get(counter, 0) + amount
+
+        resolution_stats.record(self.current_file, self.timings, counters)
+
+
+# Strings are matched so they are left alone; trailing commas and comments
+# outside of them are removed.
+SETTINGS_SYNTAX = re.compile(
+    r'("(?:\\.|[^"\\])*")|,(\s*[}\]])|//[^\n]*|/\*.*?\*/',
+    re.DOTALL
+)
+
+
+def load_settings_file(path):
+    """
+        Load a .sublime-settings file, which is JSON that may contain
+        comments and trailing commas.
+    """
+    settings_file = open(path)
+    try:
+        content = settings_file.read()
+    finally:
+        settings_file.close()
+
+    def strip(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        if match.group(2) is not None:
+            return match.group(2)
+        return ''
+
+    content = SETTINGS_SYNTAX.sub(strip, content)
+
+    return json.loads(content)
+
+
+def resolve(compiled_configuration, file_path, cache=None, timeout=None,
+            max_results=None, max_results_per_pattern=None,
+            folder_exclude_patterns=(), file_exclude_patterns=()):
+    """
+        Resolve the related files of file_path with the first configuration
+        in compiled_configuration that matches it, within the limits
+        RelatedFileResolver takes, leaving out the folders and files the
+        exclude patterns match along with the configuration's "exclude" list.
+
+        Return a dict with the file path, the name of the configuration, the
+        file type, the related files, each a dict with a label, a path and
+        whether the file exists, and whether any were left out because of
+        the limits.  Configuration and file type are None if the file did
+        not match.
+    """
+    result = {
+        'file': file_path,
+        'configuration': None,
+        'file_type': None,
+        'related': [],
+        'truncated': False
+    }
+
+    start = time.time()
+    config, app_path = compiled_configuration.match(file_path)
+    if not config:
+        return result
+
+    resolver = RelatedFileResolver(
+        config,
+        app_path,
+        file_path,
+        cache,
+        timeout=timeout,
+        max_results=max_results,
+        max_results_per_pattern=max_results_per_pattern,
+        exclude=config.get_exclude_patterns(folder_exclude_patterns, file_exclude_patterns)
+    )
+    resolver.timings['configuration_match'] = time.time() - start
+    context = resolver.get_context()
+    if not context:
+        return result
+
+    result['configuration'] = config.name
+    result['file_type'] = context.file_type
+    result['related'] = [
+        {
+            'label': label,
+            'path': path,
+            'exists': label.startswith('Open ')
+        }
+        for label, path in resolver.get_related_files()
+    ]
+    result['truncated'] = resolver.truncated
+
+    return result
+
+
+class RelatedFileGraph(object):
+    """
+        The related files of every file in a project, found by resolving the
+        rel_patterns of each file once, so that looking up the related files
+        of any file is a dictionary lookup.
+
+        Besides the edges from each file to the files its rel_patterns
+        match, a file is related to every file whose rel_patterns match it
+        when its own type has no rel_pattern for that file's type.
+
+        directory_changed() queues a directory whose contents changed; before
+        the next lookup, files added to or removed from it, or to or from
+        its subdirectories, are added to or removed from the graph, and the
+        files whose resolution listed it are resolved again.  The
+        directories scanned are watched by the cache's watcher, if it has
+        one.
+    """
+
+    def __init__(self, compiled_configuration, cache=None, exclude=None):
+        self.compiled_configuration = compiled_configuration
+        self.cache = cache or directory_cache
+        self.exclude = exclude
+        self.scanned = False
+        self._lock = threading.RLock()
+        self._related = {}
+        self._types = {}
+        self._reverse = {}
+        self._files_by_directory = {}
+        self._dependents = {}
+        self._directories_by_file = {}
+        self._changed_directories = set()
+        self._directories = set()
+
+    def scan(self, folders):
+        """
+            Add every file under folders, leaving out the folders and files
+            exclude leaves out.
+        """
+        for folder in folders:
+            self._walk(folder)
+
+        self.scanned = True
+
+    def add_file(self, file_path):
+        """
+            Add file_path, or resolve it again if it is already in the graph.
+            Files that do not match any configured file type are left out.
+        """
+        with self._lock:
+            self._unlink(file_path)
+
+            config, app_path = self.compiled_configuration.match(file_path)
+            if not config:
+                return
+
+            # Scans resolve every file in the project, which would crowd the
+            # resolutions the user asked for out of the stats.
+            resolver = RelatedFileResolver(
+                config,
+                app_path,
+                file_path,
+                self.cache,
+                record_stats=False
+            )
+            context = resolver.get_context()
+            if not context:
+                return
+
+            related_files = resolver.get_related_files()
+            self._related[file_path] = related_files
+            self._types[file_path] = (config, context.file_type)
+            self._files_by_directory.setdefault(
+                os.path.dirname(file_path),
+                set()
+            ).add(file_path)
+
+            for label, path in related_files:
+                if label.startswith('Open '):
+                    self._reverse.setdefault(path, set()).add(file_path)
+
+            directories = list(resolver.seen_directories)
+            self._directories_by_file[file_path] = directories
+            for directory in directories:
+                self._dependents.setdefault(directory, set()).add(file_path)
+
+    def remove_file(self, file_path):
+        with self._lock:
+            self._unlink(file_path)
+
+            directory = os.path.dirname(file_path)
+            files = self._files_by_directory.get(directory)
+            if files is not None:
+                files.discard(file_path)
+
+    def close(self):
+        """
+            Stop watching the directories scanned.
+        """
+        watcher = self.cache.watcher
+        with self._lock:
+            directories = self._directories
+            self._directories = set()
+
+        if watcher is not None:
+            for directory in directories:
+                watcher.unwatch(directory, self)
+
+    def directory_changed(self, path):
+        """
+            Queue a directory whose contents changed, or every directory if
+            path is None.  Safe to call from any thread, including the
+            watcher's.
+        """
+        with self._lock:
+            if path is None:
+                self.scanned = False
+            else:
+                self._changed_directories.add(path)
+
+    def get_related_files(self, file_path):
+        """
+            Get the related files of file_path as [label, path] lists, the
+            files it relates to first.  Files not in the graph yet are added.
+        """
+        self._update()
+
+        with self._lock:
+            if file_path not in self._related:
+                self.add_file(file_path)
+
+            related_files = list(self._related.get(file_path, []))
+            if file_path not in self._types:
+                return related_files
+
+            config, file_type = self._types[file_path]
+            rel_patterns = config.details['file_types'][file_type].get('rel_patterns', {})
+            related_paths = set([path for label, path in related_files])
+
+            for source in sorted(self._reverse.get(file_path, ())):
+                source_type = self._types[source][1]
+                if source_type not in rel_patterns and source not in related_paths:
+                    related_files.append([
+                        'Open %s (%s)' % (source_type, os.path.basename(source)),
+                        source
+                    ])
+
+            return related_files
+
+    def get_transitively_related_files(self, file_path, depth=2):
+        """
+            Get the files related to file_path through at most depth related
+            files, nearest first, as [label, path] lists.  Only files that
+            exist are followed and included.
+        """
+        found = set([file_path])
+        related_files = []
+        level = [file_path]
+
+        for distance in range(depth):
+            next_level = []
+            for path in level:
+                for label, related_path in self.get_related_files(path):
+                    if related_path in found or not label.startswith('Open '):
+                        continue
+
+                    found.add(related_path)
+                    next_level.append(related_path)
+                    related_files.append([label, related_path])
+
+            level = next_level
+
+        return related_files
+
+    def _update(self):
+        """
+            Bring the graph up to date with the queued directory changes.
+        """
+        with self._lock:
+            changed_directories = self._changed_directories
+            self._changed_directories = set()
+
+            for directory in changed_directories:
+                known_files = self._files_by_directory.get(directory, set())
+                try:
+                    names = os.listdir(directory)
+                except OSError:
+                    names = []
+
+                files = set()
+                subdirectories = set()
+                for name in names:
+                    path = os.path.join(directory, name)
+                    if os.path.isfile(path):
+                        if not self._excludes(name, False):
+                            files.add(path)
+                    elif os.path.isdir(path) and not self._excludes(name, True):
+                        subdirectories.add(path)
+
+                for file_path in known_files - files:
+                    self.remove_file(file_path)
+
+                for file_path in (files - known_files) | self._dependents.get(directory, set()):
+                    if file_path in files or file_path in self._related:
+                        self.add_file(file_path)
+
+                # Only the subdirectories of scanned directories are part of
+                # the project; the watcher also reports the directories the
+                # cache listed.
+                if directory not in self._directories:
+                    continue
+
+                for subdirectory in sorted(subdirectories - self._directories):
+                    self._walk(subdirectory)
+
+                for subdirectory in list(self._directories):
+                    if os.path.dirname(subdirectory) == directory \
+                            and subdirectory not in subdirectories:
+                        self._forget_directory(subdirectory)
+
+    def _walk(self, folder):
+        """
+            Add every file under folder and watch every directory, leaving
+            out the folders and files exclude leaves out.
+        """
+        watcher = self.cache.watcher
+        for dir_path, dir_names, file_names in os.walk(folder):
+            dir_names[:] = [name for name in dir_names if not self._excludes(name, True)]
+            file_names = [name for name in file_names if not self._excludes(name, False)]
+
+            with self._lock:
+                self._directories.add(dir_path)
+            if watcher is not None:
+                watcher.watch(dir_path, self)
+
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                self.add_file(os.path.join(dir_path, file_name))
+
+    def _forget_directory(self, directory):
+        """
+            Remove the files under a directory that no longer exists, and
+            stop watching it and its subdirectories.  Called with the lock
+            held.
+        """
+        watcher = self.cache.watcher
+        prefix = directory + os.sep
+        for path in list(self._directories):
+            if path != directory and not path.startswith(prefix):
+                continue
+
+            for file_path in list(self._files_by_directory.get(path, ())):
+                self.remove_file(file_path)
+
+            self._directories.discard(path)
+            if watcher is not None:
+                watcher.unwatch(path, self)
+
+    def _excludes(self, name, folder):
+        return self.exclude is not None and self.exclude.excludes(name, folder)
+
+    def _unlink(self, file_path):
+        """
+            Remove the edges from file_path.  Called with the lock held.
+        """
+        for label, path in self._related.pop(file_path, []):
+            sources = self._reverse.get(path)
+            if sources is not None:
+                sources.discard(file_path)
+
+        self._types.pop(file_path, None)
+
+        for directory in self._directories_by_file.pop(file_path, []):
+            dependents = self._dependents.get(directory)
+            if dependents is not None:
+                dependents.discard(file_path)
+
+
+SNAPSHOT_VERSION = 2
+
+
+def save_snapshot(path, compiled_configurations):
+    """
+        Save compiled_configurations and the listings in directory_cache to
+        a snapshot file at path, for load_snapshot() to read in the next
+        session.
+    """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'python': tuple(sys.version_info[:2]),
+        'configurations': dict([
+            (compiled.digest, compiled) for compiled in compiled_configurations
+        ]),
+        'listings': directory_cache.export_listings()
+    }
+
+    temporary_path = path + '.tmp'
+    try:
+        with open(temporary_path, 'wb') as snapshot_file:
+            pickle.dump(snapshot, snapshot_file, 2)
+
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary_path, path)
+    except (IOError, OSError, TypeError, pickle.PicklingError):
+        pass
+
+
+def load_snapshot(path):
+    """
+        Read the snapshot at path, adding its directory listings to
+        directory_cache, and return its compiled configurations keyed by
+        digest.  A snapshot that is missing, unreadable, or was saved by a
+        different version or Python is ignored.
+    """
+    try:
+        with open(path, 'rb') as snapshot_file:
+            snapshot = pickle.load(snapshot_file)
+    except Exception:
+        return {}
+
+    if not isinstance(snapshot, dict) \
+            or snapshot.get('version') != SNAPSHOT_VERSION \
+            or snapshot.get('python') != tuple(sys.version_info[:2]):
+        return {}
+
+    directory_cache.import_listings(snapshot['listings'])
+
+    return snapshot['configurations']
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class _ResolverServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    _ResolverServer = None
+
+
+class _ResolverRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                response = {'ok': False, 'error': 'request is not valid JSON'}
+            else:
+                response = self.server.resolver_daemon.respond(request)
+
+            self.wfile.write((json.dumps(response, sort_keys=True) + '\n').encode('utf-8'))
+
+
+class ResolverDaemon(object):
+    """
+        Answers requests for related files on a Unix socket, so that other
+        editors and tools can use the configurations of a settings file
+        without paying for cold caches on every query.
+
+        Each request and response is a JSON object on a line of its own, and
+        a client may send any number of requests over one connection.  The
+        "op" of a request is one of:
+
+            resolve         the related files of "file", as returned by
+                            resolve(), in "result"
+            batch-resolve   a list of those for each of "files", in "results"
+            invalidate      drop what is cached about the directory "path",
+                            or about every directory if it is null
+            stats           the report of resolution_stats, in "stats"
+
+        Files are resolved with the enabled configurations of the settings,
+        or with the "configurations" named in the request.  Responses to
+        resolve and batch-resolve hold the "digest" of those; a request
+        giving a "digest" is refused if it is not the same, so that a client
+        never takes files resolved with configurations other than its own.
+        A request may also give the "timeout_ms", "max_results" and
+        "max_results_per_pattern" limits and the "folder_exclude_patterns"
+        and "file_exclude_patterns" that resolve() takes.  No resolution
+        takes longer than timeout seconds, whatever the request asks for.
+
+        Responses have "ok" set to true, or to false along with an "error".
+        The "id" of a request, if any, is copied to its response.
+    """
+
+    def __init__(self, socket_path, settings, enabled_configurations, timeout=1.0):
+        if _ResolverServer is None:
+            raise OSError('Unix sockets are not supported on this platform')
+
+        self.socket_path = socket_path
+        self.settings = settings
+        self.enabled_configurations = list(enabled_configurations)
+        self.timeout = timeout
+        self._configurations = {}
+        self._configurations_lock = threading.Lock()
+
+        if os.path.exists(socket_path):
+            # A socket left behind by a daemon that did not shut down cleanly
+            # is replaced, but not one that is still being served.
+            try:
+                request_daemon(socket_path, {'op': 'stats'})
+            except (socket.error, ValueError):
+                os.remove(socket_path)
+            else:
+                raise OSError('A daemon is already serving %s' % socket_path)
+
+        # Only the user running the daemon may connect to it, from the
+        # moment the socket is created.
+        umask = os.umask(0o177)
+        try:
+            self.server = _ResolverServer(socket_path, _ResolverRequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.resolver_daemon = self
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def respond(self, request):
+        """
+            Get the response to request.
+        """
+        try:
+            response = self._respond(request)
+            response['ok'] = True
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            response = {'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}
+
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+
+        return response
+
+    def _respond(self, request):
+        operation = request['op']
+        if operation == 'resolve':
+            compiled_configuration = self._get_configuration(request)
+            return {
+                'digest': compiled_configuration.digest,
+                'result': self._resolve(compiled_configuration, request['file'], request)
+            }
+        elif operation == 'batch-resolve':
+            compiled_configuration = self._get_configuration(request)
+            return {
+                'digest': compiled_configuration.digest,
+                'results': [
+                    self._resolve(compiled_configuration, file_path, request)
+                    for file_path in request['files']
+                ]
+            }
+        elif operation == 'invalidate':
+            path = request.get('path')
+            invalidate_directory(path and os.path.abspath(path))
+            return {}
+        elif operation == 'stats':
+            return {'stats': resolution_stats.format()}
+
+        raise ValueError("Unknown op '%s'" % operation)
+
+    def _get_configuration(self, request):
+        """
+            Get the CompiledConfiguration of the configurations request asks
+            for, compiling them the first time they are asked for.
+        """
+        configurations = request.get('configurations')
+        if configurations is not None and (
+                not isinstance(configurations, list)
+                or [name for name in configurations if not isinstance(name, string_types)]):
+            raise TypeError('configurations must be a list of configuration names')
+
+        enabled_configurations = tuple(configurations or self.enabled_configurations)
+
+        with self._configurations_lock:
+            compiled_configuration = self._configurations.get(enabled_configurations)
+            if compiled_configuration is None:
+                compiled_configuration = CompiledConfiguration(
+                    self.settings,
+                    enabled_configurations
+                )
+                self._configurations[enabled_configurations] = compiled_configuration
+
+        digest = request.get('digest')
+        if digest is not None and digest != compiled_configuration.digest:
+            raise ValueError('The configurations are not the ones with digest %s' % digest)
+
+        return compiled_configuration
+
+    def _resolve(self, compiled_configuration, file_path, request):
+        timeouts = [
+            timeout for timeout in ((request.get('timeout_ms') or 0) / 1000.0, self.timeout)
+            if timeout
+        ]
+
+        return resolve(
+            compiled_configuration,
+            os.path.abspath(file_path),
+            timeout=timeouts and min(timeouts) or None,
+            max_results=request.get('max_results'),
+            max_results_per_pattern=request.get('max_results_per_pattern'),
+            folder_exclude_patterns=request.get('folder_exclude_patterns', ()),
+            file_exclude_patterns=request.get('file_exclude_patterns', ())
+        )
+
+
+def request_daemon(socket_path, request, timeout=1.0):
+    """
+        Send request to the ResolverDaemon listening on socket_path and return
+        its response.  Raises socket.error if the daemon can't be reached,
+        including on platforms without Unix sockets, or doesn't answer within
+        timeout seconds.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise socket.error('Unix sockets are not supported on this platform')
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        response = b''
+        while not response.endswith(b'\n'):
+            chunk = connection.recv(65536)
+            if not chunk:
+                raise socket.error('Connection closed by %s' % socket_path)
+            response += chunk
+    finally:
+        connection.close()
+
+    return json.loads(response.decode('utf-8'))
+
+
+_worker_configuration = None
+
+
+def _init_worker(settings, enabled_configurations):
+    global _worker_configuration
+    _worker_configuration = CompiledConfiguration(settings, enabled_configurations)
+    directory_cache.set_io_threads(settings.get('io_threads', 0))
+
+
+def _resolve_in_worker(file_path):
+    return resolve(_worker_configuration, file_path)
+
+
+def iter_files(directory):
+    for dir_path, dir_names, file_names in os.walk(directory):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            yield os.path.join(dir_path, file_name)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog --settings FILE [options] [FILE ...]',
+        description='Print the related files of each FILE, and of every file '
+                    'under --dir, as one JSON object per line, or serve them '
+                    'on a Unix socket with --daemon.'
+    )
+    parser.add_option('--settings', help='GotoRelatedFile.sublime-settings file to use')
+    parser.add_option(
+        '--configurations',
+        help='comma-separated configurations to enable, instead of the '
+             'enabled_configurations in the settings file'
+    )
+    parser.add_option('--dir', help='resolve every file under this directory')
+    parser.add_option(
+        '--jobs',
+        type='int',
+        default=1,
+        help='number of worker processes (default: 1)'
+    )
+    parser.add_option(
+        '--daemon',
+        metavar='SOCKET',
+        help='keep running and answer requests on this Unix socket'
+    )
+    options, files = parser.parse_args(argv)
+
+    if not options.settings:
+        parser.error('--settings is required')
+    if options.daemon and (files or options.dir):
+        parser.error('--daemon does not take files or --dir')
+
+    settings = load_settings_file(options.settings)
+    if options.configurations:
+        enabled_configurations = options.configurations.split(',')
+    else:
+        enabled_configurations = settings.get('enabled_configurations', [])
+
+    if options.daemon:
+        directory_cache.set_io_threads(settings.get('io_threads', 0))
+        if settings.get('watch_directories', True):
+            start_directory_watcher()
+
+        timeout_ms = settings.get('resolve_timeout_ms', 1000)
+        try:
+            daemon = ResolverDaemon(
+                os.path.abspath(options.daemon),
+                settings,
+                enabled_configurations,
+                timeout_ms and timeout_ms / 1000.0
+            )
+        except (OSError, socket.error) as error:
+            parser.error(str(error))
+
+        # Remove the socket when terminated, not only when interrupted.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    files = [os.path.abspath(file_path) for file_path in files]
+    if options.dir:
+        files = itertools.chain(files, iter_files(os.path.abspath(options.dir)))
+
+    if options.jobs > 1:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(
+            options.jobs,
+            _init_worker,
+            (settings, enabled_configurations)
+        )
+        results = pool.imap(_resolve_in_worker, files, 64)
+    else:
+        pool = None
+        _init_worker(settings, enabled_configurations)
+        results = (_resolve_in_worker(file_path) for file_path in files)
+
+    try:
+        for result in results:
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,12 +11,12 @@ test_suites = {
 }
 
 
-def print_to_view(view, obtain_content):
+def print_to_view(view, obtain_content, name='unittest results'):
     edit = view.begin_edit()
     view.insert(edit, 0, obtain_content())
     view.end_edit(edit)
     view.set_scratch(True)
-    view.set_name('unittest results')
+    view.set_name(name)
 
     return view
 